@@ -35,3 +35,6 @@ class DEC_Updater(Mapping):
 
         fit_callback(self.model, train, val)
         self.score()
+
+    def n_classes(self):
+        return self.cluster.config.n_clusters
@@ -0,0 +1,96 @@
+
+import math
+import numpy as np
+
+from keras.utils import Sequence
+from keras.utils import np_utils
+
+from muon.utils.camera import CameraRotate
+from muon.utils.subjects import SubjectArrays
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SubjectSequence(Sequence):
+    """
+    Keras Sequence of mini-batches drawn from a Subjects store.
+
+    Batches are shuffled, normalized and rotated when they are requested,
+    so training with rotation only needs memory for the subject charges
+    and one batch, instead of six scaled copies of every subject.
+    """
+
+    def __init__(self, subjects, labels=None, batch_size=256,
+                 rotation=False, n_classes=None, shuffle=True,
+                 autoencoder=False):
+        """
+        subjects: Subjects to draw batches from
+        labels: dict of subject id to label, defaults to subject labels
+        rotation: include all six rotations of each subject, or
+                  'reflect' for all twelve rotations and reflections
+        n_classes: one hot encode labels with this many classes
+        autoencoder: use the charges as targets instead of labels
+        """
+        self.subjects = subjects
+        self.batch_size = batch_size
+        self.rotation = rotation
+        self.n_classes = n_classes
+        self.shuffle = shuffle
+        self.autoencoder = autoencoder
+
+        if labels is None:
+            y = subjects.labels
+        else:
+            y = np.array([labels[s] for s in subjects.keys()])
+        self.y = y
+
+        self._rotation = None
+        if rotation:
+            self._rotation = CameraRotate().group(rotation)
+
+        self.order = np.arange(self.samples)
+        if shuffle:
+            np.random.shuffle(self.order)
+
+    @property
+    def samples(self):
+        if self.rotation:
+            return len(self.subjects) * len(self._rotation)
+        return len(self.subjects)
+
+    def __len__(self):
+        return math.ceil(self.samples / self.batch_size)
+
+    def __getitem__(self, i):
+        a = i * self.batch_size
+        b = min(self.samples, a + self.batch_size)
+        samples = self.order[a:b]
+
+        if self.rotation:
+            rows = samples // len(self._rotation)
+            rotations = samples % len(self._rotation)
+        else:
+            rows = samples
+            rotations = None
+
+        # Sorted reads are much faster for memory mapped charges
+        _rows, inverse = np.unique(rows, return_inverse=True)
+        charge = self.subjects.charge_rows(_rows)[inverse]
+        x = SubjectArrays.scale(charge)
+
+        if rotations is not None:
+            index = self._rotation[rotations]
+            x = x[np.arange(len(x))[:, np.newaxis], index]
+
+        if self.autoencoder:
+            return x, x
+
+        y = self.y[rows]
+        if self.n_classes:
+            y = np_utils.to_categorical(y, self.n_classes)
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
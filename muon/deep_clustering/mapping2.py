@@ -19,8 +19,8 @@ from keras.utils import np_utils
 from keras.engine.topology import Layer
 from keras import backend as K
 
-from muon.utils.camera import CameraRotate
 import muon.deep_clustering.utils as utils
+from muon.deep_clustering.generator import SubjectSequence
 
 
 class MapInitializer(Initializer):
@@ -182,6 +182,28 @@ class Mapping:
         fit_callback(self.model, train, val)
         self.score()
 
+    def fit_sequence(self, fit_callback, rotation=True, batch_size=256):
+        """
+        Fit with training batches generated on demand, so rotated
+        training data is never built in memory.
+
+        fit_callback receives the model, a SubjectSequence of training
+        batches and the validation data, and should call fit_generator
+        """
+        subjects = self.cluster.subjects.subset(self.train.subset)
+        train = SubjectSequence(
+            subjects, self.train.labels, batch_size=batch_size,
+            rotation=rotation, n_classes=self.n_classes())
+
+        x, y = self.validate.get_xy()
+        val = (x, np_utils.to_categorical(y, self.n_classes()))
+
+        fit_callback(self.model, train, val)
+        self.score()
+
+    def n_classes(self):
+        return len(self.classes)
+
     def pca_plot(self):
         self.cluster.pca_plot()
 
@@ -12,9 +12,9 @@ from keras.utils import np_utils
 from keras import optimizers
 from sklearn.metrics import f1_score
 
-from muon.utils.camera import CameraRotate
 import muon.data
 import muon.deep_clustering.utils as utils
+from muon.deep_clustering.generator import SubjectSequence
 
 logger = logging.getLogger(__name__)
 
@@ -82,20 +82,9 @@ class Supervised:
 
     @staticmethod
     def get_xy(subjects, rotation, hot_encode=False):
-        x = []
-        y = []
-        cr = CameraRotate()
-        for s in subjects.iter():
-            if rotation:
-                for n in range(6):
-                    x.append(cr.rotate(s.scaled_charge, n))
-                    y.append(s.label)
-            else:
-                x.append(s.scaled_charge)
-                y.append(s.label)
-
-        x = np.array(x)
-        y = np.array(y)
+        x, y = subjects.get_charge_array(
+            order=False, labels=True, rotation=rotation)[:2]
+
         if hot_encode:
             y = np_utils.to_categorical(y, 2)
         return x, y
@@ -113,9 +102,16 @@ class Supervised:
         epochs = self.config.epochs
         patience = self.config.patience
 
-        xy = self.get_xy_subsets(subjects, rotation, hot_encode=True)
-        train = xy['train']
-        validate = xy['validate']
+        batch_size = self.config.batch_size
+
+        def sequence(k):
+            subset = subjects.subset(self.subsets[k])
+            return SubjectSequence(
+                subset, batch_size=batch_size, rotation=rotation,
+                n_classes=2, shuffle=(k == 'train'))
+
+        train = sequence('train')
+        validate = sequence('validate')
 
         callbacks = [
             ModelCheckpoint(
@@ -127,8 +123,9 @@ class Supervised:
         ]
 
         model = self.model
-        model.fit(*train, validation_data=validate, epochs=epochs,
-                  batch_size=256, callbacks=callbacks)
+        model.fit_generator(
+            train, validation_data=validate, epochs=epochs,
+            callbacks=callbacks, workers=self.config.workers)
 
 
 class Config:
@@ -141,6 +138,8 @@ class Config:
         self.rotation = rotation
         self.epochs = kwargs.get('epochs', 100)
         self.patience = kwargs.get('patience', 10)
+        self.batch_size = kwargs.get('batch_size', 256)
+        self.workers = kwargs.get('workers', 1)
 
         save_dir = save_dir or muon.data.dir()
         self.save_dir = os.path.abspath(save_dir)
@@ -0,0 +1,135 @@
+
+import math
+import numpy as np
+
+
+class ImageGeometry:
+    """
+    Pixel layout of a grid image of subjects, computed from the grid
+    shape alone so images can be decoded without rendering them.
+
+    Tiles are square, two inches wide, laid out row by row from the top
+    left, after a band of offset inches on the top and left.
+
+    version 1 is the layout of Subjects.plot_subjects and GridRenderer.
+    version 0 is the layout of the beta images, drawn before the offset
+    bug was fixed: the tiles fill 97% of the figure and start 3% of
+    its height from the top.
+    """
+
+    version = 1
+
+    def __init__(self, rows, cols, dpi=100, offset=.5, width=None,
+                 height=None, version=None):
+        """
+        rows, cols: grid shape
+        dpi: pixels per inch
+        offset: width of the label band in inches
+        width, height: figure size in inches, from the grid shape
+                       by default
+        """
+        self.rows = rows
+        self.cols = cols
+        self.dpi = dpi
+        self.offset = offset
+        self.width = width or 2*cols + offset
+        self.height = height or 2*rows + offset
+        if version is not None:
+            self.version = version
+
+    @classmethod
+    def for_subjects(cls, n, cols, **kwargs):
+        """
+        Geometry of an image of n subjects in a grid cols wide
+        """
+        return cls(max(1, math.ceil(n / cols)), cols, **kwargs)
+
+    @classmethod
+    def beta(cls, rows, cols, dpi=100):
+        """
+        Geometry of a beta image
+        """
+        return cls(rows, cols, dpi, offset=.03*2*cols, width=2*cols,
+                   height=2*rows, version=0)
+
+    @classmethod
+    def from_metadata(cls, meta):
+        """
+        Geometry from the figure metadata stored with an image
+        """
+        version = meta.get('version')
+        if version is None:
+            version = 0 if meta.get('beta_image') else 1
+        return cls(meta['rows'], meta['cols'], meta['dpi'], meta['offset'],
+                   meta['width'], meta['height'], version)
+
+    def metadata(self):
+        meta = {
+            'dpi': self.dpi,
+            'offset': self.offset,
+            'height': self.height,
+            'width': self.width,
+            'rows': self.rows,
+            'cols': self.cols,
+            'version': self.version,
+        }
+        if self.version == 0:
+            meta['beta_image'] = True
+        return meta
+
+    @property
+    def shape(self):
+        """
+        Height and width of the image in pixels
+        """
+        return (int(round(self.height * self.dpi)),
+                int(round(self.width * self.dpi)))
+
+    @property
+    def origin(self):
+        """
+        Pixel x, y of the top left corner of the first tile
+        """
+        offset = self.offset * self.dpi
+        if self.version == 0:
+            return offset, .03 * self.height * self.dpi
+        return offset, offset
+
+    @property
+    def tile(self):
+        """
+        Width and height of a tile in pixels
+        """
+        if self.version == 0:
+            width = self.width * self.dpi * .97
+            height = self.height * self.dpi * .97
+        else:
+            width = (self.width - self.offset) * self.dpi
+            height = (self.height - self.offset) * self.dpi
+        return width / self.cols, height / self.rows
+
+    def locate(self, x, y):
+        """
+        Grid positions of pixel coordinates
+
+        x, y: arrays of pixel coordinates from the top left
+
+        Returns the grid index of each point, row by row, and whether
+        the point falls inside the grid
+        """
+        x0, y0 = self.origin
+        w, h = self.tile
+        col = np.floor((np.asarray(x, dtype='float64') - x0) / w)
+        row = np.floor((np.asarray(y, dtype='float64') - y0) / h)
+
+        valid = (col >= 0) & (col < self.cols) & \
+                (row >= 0) & (row < self.rows)
+        index = (col + self.cols * row).astype('int64')
+        return index, valid
+
+    def __str__(self):
+        return 'ImageGeometry v%d rows %d cols %d dpi %d offset %s' % \
+            (self.version, self.rows, self.cols, self.dpi, self.offset)
+
+    def __repr__(self):
+        return str(self)
@@ -2,14 +2,20 @@ import numpy as np
 import math
 import os
 import json
-from shutil import copyfile
+import hashlib
+from shutil import rmtree
 import random
+import tempfile
+import multiprocessing
 import matplotlib.pyplot as plt
 from collections import OrderedDict
 import csv
 import socket
 
 import muon.project.panoptes as panoptes
+from muon.project.geometry import ImageGeometry
+from muon.project.structure import StructureStore
+from muon.utils.subjects import Subjects, MappedSubjects
 import muon.config
 
 import muon.data
@@ -81,77 +87,110 @@ class Image:
         """
         return 'muon_group_%d_id_%d.png' % (self.group, self.id)
 
-    def plot(self, width, subjects, path=None):
+    def plot(self, width, subjects, path=None, renderer=None,
+             overwrite=False):
         """
         Generate and save a plot of this image
+
+        renderer: GridRenderer to draw the image without matplotlib
+                  figures
+        overwrite: replace an existing image file
         """
         subjects = subjects.subset(self.subjects)
         fname = self.fname()
+        if path:
+            fname = os.path.join(path, fname)
 
         # Skip if image already exists
-        if fname in os.listdir(path):
+        if not overwrite and os.path.isfile(fname):
             return
 
-        if path:
-            fname = os.path.join(path, fname)
-
-        offset = .5
-        dpi = 100
-        fig, meta = subjects.plot_subjects(
-            w=width, grid=True, grid_args={'offset': offset}, meta=True)
+        if renderer is not None:
+            metadata = renderer.save(fname, subjects.charge, width)
+            self.metadata.update({'figure': metadata})
+            return
 
-        metadata = {
-            'dpi': dpi,
-            'offset': offset,
-            **meta
-        }
-        self.metadata.update({'figure': metadata})
+        geometry = ImageGeometry.for_subjects(len(subjects), width)
+        fig = subjects.plot_subjects(
+            w=width, grid=True, grid_args={'offset': geometry.offset})
+        self.metadata.update({'figure': geometry.metadata()})
 
-        fig.savefig(fname, dpi=dpi)
+        fig.savefig(fname, dpi=geometry.dpi)
 
         plt.close(fig)
 
+    def input_hash(self, width, subjects, renderer=None):
+        """
+        Hash of everything the rendered image depends on: subject ids
+        and charges, grid width and rendering parameters
+        """
+        if renderer is None:
+            params = {'renderer': 'matplotlib', 'cmap': muon.config.cmap,
+                      'dpi': 100, 'offset': .5}
+        else:
+            params = renderer.params()
+        params['width'] = width
+
+        h = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+        h.update(np.array(self.subjects, dtype='int64').tobytes())
+        charge = subjects.subset(self.subjects).charge
+        h.update(np.ascontiguousarray(charge, dtype='float64').tobytes())
+        return h.hexdigest()
+
+    def geometry(self, cols=None):
+        """
+        Pixel layout of this image, from its figure metadata or else
+        from the number of subjects and the grid width cols
+        """
+        if 'figure' in (self.metadata or {}):
+            return ImageGeometry.from_metadata(self.metadata['figure'])
+        if cols is None:
+            raise Exception('Image %d has no figure metadata' % self.id)
+        return ImageGeometry.for_subjects(len(self.subjects), cols)
+
     def at_location(self, x, y):
         """
         Return the subject that should be at the given x,y coordinates
         """
-        meta = self.metadata['figure']
-        print(meta)
-        dpi = meta['dpi']
-        offset = meta['offset']*dpi
-        height = meta['height']*dpi-offset
-        width = meta['width']*dpi-offset
+        index, valid = self.geometry().locate(x, y)
+        if not valid or index >= len(self.subjects):
+            raise IndexError('Location %s, %s outside image %d' %
+                             (str(x), str(y), self.id))
+        return self.subjects[int(index)]
+
 
-        if 'beta_image' in meta:
-            # This image was generated before the offset bug was discovered
-            # and need to correct the vertical offset to get the right
-            # boundary calculations
-            width = meta['width']*dpi*0.97
-            height = meta['height']*dpi*0.97
-            y = y - 0.03*meta['height']*dpi + offset
+# State of each image generation worker process, set once by
+# _init_worker so subjects are not sent with every image
+_worker = {}
 
-        y_ = height/meta['rows']
-        x_ = width/meta['cols']
-        print('x: ', x)
-        print('y: ', y)
-        print('offset: ', offset)
-        print('width: ', width)
-        print('height: ', height)
 
-        print('x_: ', x_)
-        print('y_: ', y_)
+def _init_worker(store, width, path, renderer):
+    # Counts copied from the parent's tile cache are not this worker's
+    if renderer is not None and renderer.cache is not None:
+        renderer.cache.take_counts()
+    _worker.update({
+        'subjects': Subjects.load(store),
+        'width': width,
+        'path': path,
+        'renderer': renderer,
+    })
 
-        x = (x-offset)//x_
-        y = (y-offset)//y_
 
-        i = int(x+meta['cols']*y)
-        print(i)
-        return self.subjects[i]
+def _plot_worker(image):
+    renderer = _worker['renderer']
+    image.plot(_worker['width'], _worker['subjects'], _worker['path'],
+               renderer, overwrite=True)
+
+    counts = None
+    if renderer is not None and renderer.cache is not None:
+        counts = renderer.cache.take_counts()
+    return image.id, image.metadata.get('figure'), counts
 
 
 class Images_Parent:
     _image = Image
     _loaded_images = {}
+    _stores = {}
 
     def __init__(self, group, images, next_id):
         self.images = images
@@ -187,26 +226,27 @@ class Images_Parent:
     @classmethod
     def load_group(cls, group, fname=None):
         """
-        Load Images object from group entry in structures json file
-        """
-        if fname is None:
-            fname = cls._fname()
-        if os.path.isfile(fname):
-            with open(fname, 'r') as file:
-                data = json.load(file)
+        Load Images object from group entry in the structure store
 
-        next_id = data['next_id']
-        data = data['groups'][str(group)]
+        fname: structure database, or a structure json file, defaults
+               to the store of this host
+        """
+        store = cls._store(fname)
+        data = store.load_group(group)
+        if data is None:
+            raise Exception('Group (%s) not in structure store' % group)
+        metadata, dumps = data
+        _, next_id = store.counters()
 
         images = OrderedDict()
-        for item in data['images']:
+        for item in dumps:
             image = cls._image.load(item)
             if image.metadata.get('deleted') is True:
                 continue
             images[image.id] = image
 
         images = cls(group, images, next_id)
-        images.metadata(data['metadata'])
+        images.metadata(metadata)
 
         cls._loaded_images[group] = images
         return images
@@ -216,99 +256,84 @@ class Images_Parent:
 
     @staticmethod
     def _fname():
+        fname = '%s_structure.sqlite' % socket.gethostname()
+        return muon.data.path(fname)
+
+    @staticmethod
+    def _json_fname():
         fname = '%s_structure.json' % socket.gethostname()
         return muon.data.path(fname)
 
-    def save_group(self, overwrite=False, backup=None):
+    @classmethod
+    def _store(cls, fname=None):
         """
-        Save the configuration of this Images object to the structures
-        json file
-Split Images class into parent and main class
-
-Also added splinter function and better structure saving"""
-        images = self.list()
-        group = str(self.group)
-
-        fname = self._fname()
-        data = self._load_data()
-        if data:
-            if backup is None:
-                backup = fname+'.bak'
-            copyfile(fname, backup)
-        else:
-            data = {'groups': {}}
-
-        if group in data['groups'] and not overwrite:
-            print('file contents: ', data)
-            raise Exception('Refusing to overwrite group (%s) in structure '
-                            'file' % group)
+        StructureStore of fname, opened once per process
 
-        data['groups'][group] = {
-            'metadata': self.metadata(),
-            'images': [i.dump() for i in images]
-        }
+        The first time the store of this host is opened, the groups in
+        its old structure json file are imported
+        """
+        if fname is None:
+            fname = cls._fname()
+        if fname not in cls._stores:
+            if fname.endswith('.json'):
+                store = StructureStore.from_json(fname)
+            else:
+                new = not os.path.isfile(fname)
+                store = StructureStore(fname)
+                legacy = cls._json_fname()
+                if new and fname == cls._fname() and os.path.isfile(legacy):
+                    try:
+                        store.import_json(legacy)
+                    except Exception:
+                        # Leave no empty store behind, so the import is
+                        # tried again next time
+                        store.close()
+                        os.remove(fname)
+                        raise
+            cls._stores[fname] = store
+        return cls._stores[fname]
 
-        # TODO save to different file per upload...? Or have them all in the
-        # same file. Probably want them all in the same file.
-        # TODO do we need a separate file per workflow?
-        self.update_metadata(data)
-        self._save_data(data)
+    def save_group(self, overwrite=False, backup=None):
+        """
+        Save the configuration of this Images object to the structure
+        store. Only the rows of this group are written, in one
+        transaction.
 
-    @classmethod
-    def _load_data(cls):
-        fname = cls._fname()
-        if os.path.isfile(fname):
-            with open(fname, 'r') as file:
-                data = json.load(file)
-            return data
+        backup: copy the store to this file before saving
+        """
+        store = self._store()
+        if backup is not None:
+            store.backup(backup)
 
-    @classmethod
-    def _save_data(cls, data):
-        fname = cls._fname()
-        with open(fname, 'w') as file:
-            json.dump(data, file)
+        store.save_group(self.group, self.metadata(),
+                         [i.dump() for i in self.list()], overwrite)
+        self.update_metadata()
 
     @classmethod
-    def load_metadata(cls, data=None):
+    def load_metadata(cls):
         """
-        Load metadata stored in the header of the structures json file
+        Load the next group and image id from the structure store
         """
-        if data is None:
-            data = cls._load_data()
-        if data:
-            next_id = data['next_id']
-            group = data['next_group']
-        else:
-            next_id = 0
-            group = 0
+        return cls._store().counters()
 
-        return group, next_id
-
-    def update_metadata(self, data=None):
-        if data is None:
-            save = False
-            data = self._load_data()
-        else:
-            save = True
-
-        group = max(self.group+1, data['next_group'])
-        data['next_group'] = group
-
-        next_id = max(self.next_id, data['next_id'])
-        data['next_id'] = next_id
-
-        if save:
-            self._save_data(data)
-        return data
+    def update_metadata(self):
+        """
+        Raise the stored counters past this group and its image ids
+        """
+        group, next_id = self._store().update_counters(
+            self.group+1, self.next_id)
+        return {'next_group': group, 'next_id': next_id}
 
     @classmethod
     def _list_groups(cls):
-        data = cls._load_data()
-        return list(data['groups'].keys())
+        return [str(g) for g in cls._store().groups()]
 
 class Images(Images_Parent):
     _image = Image
 
+    # Generation manifest in each group's image directory
+    manifest_name = 'manifest.json'
+
     def __init__(self, group, images, next_id, **kwargs):
         super().__init__(group, images, next_id)
 
@@ -362,7 +387,11 @@ class Images(Images_Parent):
             b = min(l, a + self.size)
             subset = subjects[a:b]
 
-            images[i] = Image(i, self.group, subset, None)
+            # Store the layout now so clicks can be decoded without
+            # rendering the image first
+            geometry = ImageGeometry.for_subjects(len(subset), self.image_dim)
+            meta = {'figure': geometry.metadata()}
+            images[i] = Image(i, self.group, subset, meta)
 
             i += 1
         self.next_id = i
@@ -458,16 +487,112 @@ class Images(Images_Parent):
             for image in self.iter():
                 writer.writerow(image.dump_manifest())
 
-    def generate_images(self, subjects, path=None):
+    def generate_images(self, subjects, path=None, renderer=None,
+                        workers=1):
         """
         Generate subject images to be uploaded to Panoptes
+
+        renderer: GridRenderer to draw images with, instead of
+                  matplotlib figures
+        workers: number of processes to render images in
+
+        Images whose inputs match the group's generation manifest and
+        whose file exists are skipped. Returns the number skipped.
         """
         path = os.path.join(path, 'group_%d' % self.group)
         if not os.path.isdir(path):
             os.mkdir(path)
+
+        manifest = self._load_manifest(path)
+        existing = set(os.listdir(path))
+
+        todo = []
+        hashes = {}
         for image in self.iter():
-            print(image)
-            image.plot(self.image_dim, subjects, path)
+            fname = image.fname()
+            hashes[fname] = image.input_hash(
+                self.image_dim, subjects, renderer)
+            if fname in existing and manifest.get(fname) == hashes[fname]:
+                continue
+            todo.append(image)
+
+        skipped = len(self.images) - len(todo)
+        print('Generating %d images, skipping %d unchanged' %
+              (len(todo), skipped))
+
+        try:
+            if workers > 1:
+                self._generate_parallel(
+                    subjects, path, renderer, workers, todo, manifest,
+                    hashes)
+            else:
+                for image in todo:
+                    print(image)
+                    image.plot(self.image_dim, subjects, path, renderer,
+                               overwrite=True)
+                    manifest[image.fname()] = hashes[image.fname()]
+        finally:
+            self._save_manifest(path, manifest)
+        return skipped
+
+    @classmethod
+    def _load_manifest(cls, path):
+        """
+        Generation manifest of a group directory, image file name to
+        the hash of its inputs
+        """
+        fname = os.path.join(path, cls.manifest_name)
+        if os.path.isfile(fname):
+            with open(fname, 'r') as file:
+                return json.load(file)['images']
+        return {}
+
+    @classmethod
+    def _save_manifest(cls, path, manifest):
+        fname = os.path.join(path, cls.manifest_name)
+        with open(fname + '.tmp', 'w') as file:
+            json.dump({'images': manifest}, file)
+        os.replace(fname + '.tmp', fname)
+
+    def _generate_parallel(self, subjects, path, renderer, workers,
+                           images, manifest, hashes):
+        """
+        Render images in a pool of worker processes. Workers open the
+        subjects as a memory mapped store, writing a temporary one of
+        just the subjects in these images if the subjects are not
+        already memory mapped, and the figure metadata they compute is
+        merged back into the images.
+        """
+        if not images:
+            return
+
+        tmp = None
+        if isinstance(subjects, MappedSubjects) and not subjects.is_view():
+            store = subjects.path
+        else:
+            tmp = tempfile.mkdtemp(prefix='muon_subjects_')
+            store = tmp
+            ids = np.unique([s for i in images for s in i.subjects])
+            subjects.subset(ids).save_mapped(store)
+
+        try:
+            initargs = (store, self.image_dim, path, renderer)
+            with multiprocessing.Pool(
+                    workers, _init_worker, initargs) as pool:
+                done = pool.imap_unordered(_plot_worker, images)
+                for id_, figure, counts in done:
+                    image = self.images[id_]
+                    print(image)
+                    if figure is not None:
+                        image.metadata['figure'] = figure
+                    if counts is not None:
+                        renderer.cache.add_counts(counts)
+                    manifest[image.fname()] = hashes[image.fname()]
+        finally:
+            if tmp is not None:
+                rmtree(tmp)
+            if renderer is not None and renderer.cache is not None:
+                renderer.cache.refresh()
 
 
 class Random_Images(Images):
@@ -491,8 +616,11 @@ class Random_Images(Images):
             subsets = self.split_subjects(subjects)
 
             for subset in subsets:
+                geometry = ImageGeometry.for_subjects(
+                    len(subset), self.image_dim)
                 meta = {
                     'cluster': c,
+                    'figure': geometry.metadata(),
                 }
                 images[i] = Image(i, self.group, subset, meta)
                 i += 1
@@ -4,6 +4,7 @@ import csv
 import json
 from datetime import datetime
 import os
+import numpy as np
 
 from muon.project.images import MultiGroupImages
 import muon.data
@@ -62,6 +63,9 @@ class Config:
 
 class Aggregate:
 
+    # Annotations whose clicks mark subjects
+    marked = ['most_muons', 'most_nonmuons']
+
     def __init__(self, name, config, images=None, data=None, parsed=None):
         self.name = name
         self.config = config
@@ -75,6 +79,10 @@ class Aggregate:
         self.data = data
         self.parsed = parsed
 
+        # (image id, x, y) of clicks outside their image's grid,
+        # since the start of the last aggregation
+        self.out_of_bounds = []
+
     @classmethod
     def from_parse(cls, parse):
         return cls(parse.name, parse.config, parse.images, parsed=parse)
@@ -83,44 +91,50 @@ class Aggregate:
         parsed = self.parsed
         if self.parsed is None:
             parsed = Parse.load(self.name)
+        self.out_of_bounds = []
 
-        images = {}
-        subjects = {}
+        # Decode every click of the export in one batch
+        annotations = []
         for zoo_id, item in parsed.data.items():
             image = self.images.get_zoo(zoo_id)
-
             for value, clicks in item:
-                if value == 'all_muons':
-                    l = len(image.subjects)
-                    self._annotate_i(images, image.id, l, l)
-
-                    for subject in image.subjects:
-                        self._annotate_s(subjects, subject, 1)
-
-                elif value == 'no_muons':
-                    l = len(image.subjects)
-                    self._annotate_i(images, image.id, 0, l)
-
-                    for subject in image.subjects:
-                        self._annotate_s(subjects, subject, 0)
-
-                else:
-                    _subjects = self.parse_subjects(image, clicks)
-                    total = len(image.subjects)
-                    l = len(clicks)
-
-                    if value == 'most_muons':
-                        v = (0, 1)
-                        self._annotate_i(images, image.id, total-l, total)
-                    elif value == 'most_nonmuons':
-                        v = (1, 0)
-                        self._annotate_i(images, image.id, l, total)
-
-                    for subject in image.subjects:
-                        if subject in _subjects:
-                            self._annotate_s(subjects, subject, v[0])
-                        else:
-                            self._annotate_s(subjects, subject, v[1])
+                annotations.append((image, value, clicks))
+        decoded = self._decode_annotations(annotations)
+
+        images = {}
+        subjects = {}
+        for n, (image, value, clicks) in enumerate(annotations):
+            if value == 'all_muons':
+                l = len(image.subjects)
+                self._annotate_i(images, image.id, l, l)
+
+                for subject in image.subjects:
+                    self._annotate_s(subjects, subject, 1)
+
+            elif value == 'no_muons':
+                l = len(image.subjects)
+                self._annotate_i(images, image.id, 0, l)
+
+                for subject in image.subjects:
+                    self._annotate_s(subjects, subject, 0)
+
+            else:
+                _subjects = decoded[n]
+                total = len(image.subjects)
+                l = len(clicks)
+
+                if value == 'most_muons':
+                    v = (0, 1)
+                    self._annotate_i(images, image.id, total-l, total)
+                elif value == 'most_nonmuons':
+                    v = (1, 0)
+                    self._annotate_i(images, image.id, l, total)
+
+                for subject in image.subjects:
+                    if subject in _subjects:
+                        self._annotate_s(subjects, subject, v[0])
+                    else:
+                        self._annotate_s(subjects, subject, v[1])
 
         data = {'images': images, 'subjects': subjects}
         self.data = data
@@ -152,9 +166,7 @@ class Aggregate:
         return subjects
 
     def apply_labels(self, subjects):
-        labels = self.subject_labels()
-        for s, l in labels.items():
-            subjects[s].label = l
+        subjects.set_labels(self.subject_labels())
 
     @staticmethod
     def _annotate_i(images, image, muons, total):
@@ -170,14 +182,88 @@ class Aggregate:
         subjects[subject].append(value)
 
     def parse_subjects(self, image, coordinates):
-        subjects = []
-        try:
-            for x, y in coordinates:
-                subjects.append(image.at_location(x, y))
-        except Exception as e:
-            print(image)
-            raise e
-        return subjects
+        ids = np.full(len(coordinates), image.id)
+        x, y = np.array(coordinates, dtype='float64').reshape(-1, 2).T
+        subjects, valid = self.decode_clicks(ids, x, y)
+        return subjects[valid].tolist()
+
+    def _decode_annotations(self, annotations):
+        """
+        Decode the clicks of a list of (image, value, clicks) annotations
+        together, returning the set of clicked subjects of each
+
+        Only most_muons and most_nonmuons annotations mark subjects, so
+        clicks of other annotations are ignored and their set is empty
+        """
+        marked = [value in self.marked for _, value, _ in annotations]
+        counts = [len(clicks) if m else 0
+                  for (_, _, clicks), m in zip(annotations, marked)]
+        ids = np.repeat([image.id for image, _, _ in annotations], counts)
+        coordinates = [c for (_, _, clicks), m in zip(annotations, marked)
+                       if m for c in clicks]
+        x, y = np.array(coordinates, dtype='float64').reshape(-1, 2).T
+
+        subjects, valid = self.decode_clicks(ids, x, y)
+        split = np.cumsum(counts)[:-1]
+        return [set(s[v].tolist()) for s, v in
+                zip(np.split(subjects, split), np.split(valid, split))]
+
+    def decode_clicks(self, image_ids, x, y):
+        """
+        Map clicks to subjects, with one geometry computation for all
+        clicks on images with the same layout
+
+        image_ids, x, y: arrays with the image id and pixel location of
+                         each click
+
+        Returns the subject id of each click, -1 where the click is
+        outside its image's grid, and whether each click was valid.
+        Invalid clicks are reported together and kept in
+        out_of_bounds.
+        """
+        image_ids = np.asarray(image_ids, dtype='int64')
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+
+        # Subjects of every clicked image in one flat array
+        unique, inverse = np.unique(image_ids, return_inverse=True)
+        images = [self.images.images[i] for i in unique]
+        lengths = np.array([len(i.subjects) for i in images], dtype='int64')
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        flat = np.array([s for i in images for s in i.subjects],
+                        dtype='int64')
+
+        # Group images by layout
+        layouts = {}
+        for n, image in enumerate(images):
+            geometry = image.geometry()
+            key = tuple(sorted(geometry.metadata().items()))
+            if key not in layouts:
+                layouts[key] = (geometry, [])
+            layouts[key][1].append(n)
+
+        index = np.zeros(len(x), dtype='int64')
+        valid = np.zeros(len(x), dtype=bool)
+        for geometry, members in layouts.values():
+            clicks = np.isin(inverse, members)
+            index[clicks], valid[clicks] = \
+                geometry.locate(x[clicks], y[clicks])
+
+        # Clicks in empty cells of the last row are out of bounds too
+        valid &= index < lengths[inverse]
+
+        subjects = np.full(len(x), -1, dtype='int64')
+        subjects[valid] = flat[starts[inverse[valid]] + index[valid]]
+
+        bad = np.where(~valid)[0]
+        if len(bad) > 0:
+            self.out_of_bounds.extend(
+                zip(image_ids[bad].tolist(), x[bad].tolist(),
+                    y[bad].tolist()))
+            print('%d of %d clicks outside their image, in %d images' %
+                  (len(bad), len(x), len(np.unique(image_ids[bad]))))
+
+        return subjects, valid
 
     @staticmethod
     def fname(name):
@@ -0,0 +1,407 @@
+
+import hashlib
+import math
+import os
+import string
+import tempfile
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.image
+from matplotlib.path import Path
+from matplotlib.textpath import TextPath
+
+from muon.utils.camera import Camera
+from muon.project.geometry import ImageGeometry
+import muon.config
+
+
+class GridRenderer:
+    """
+    Renders an image grid of subjects straight into one RGB buffer,
+    without building a matplotlib figure.
+
+    The layout matches Subjects.plot_subjects with a grid: square tiles
+    of two inches, a band of offset inches on the top and left holding
+    row numbers and column letters, and grid lines between tiles. Every
+    output pixel of a tile is assigned to a camera pixel once per grid
+    shape, so drawing a subject is a colour lookup.
+    """
+
+    # Camera data limits of each tile, as set by CameraPlot.plot
+    bounds = 21.
+    # Space between tiles as a fraction of the tile axes
+    space = .05
+
+    def __init__(self, dpi=100, offset=.5, cmap=None, fontsize=14,
+                 cache=None):
+        """
+        cache: TileCache to reuse rendered subject tiles from
+        """
+        self.dpi = dpi
+        self.offset = offset
+        self.cmap = plt.get_cmap(cmap or muon.config.cmap)
+        self.fontsize = fontsize
+        self.cache = cache
+
+        self._masks = {}
+        self._glyphs = {}
+
+    def params(self):
+        """
+        Parameters that change the rendered image
+        """
+        return {'renderer': 'numpy', 'cmap': self.cmap.name,
+                'dpi': self.dpi, 'offset': self.offset,
+                'fontsize': self.fontsize}
+
+    def geometry(self, n, cols):
+        """
+        ImageGeometry of a grid of n subjects cols wide
+        """
+        return ImageGeometry.for_subjects(
+            n, cols, dpi=self.dpi, offset=self.offset)
+
+    ##########################################################################
+    ###   Hexagon Masks   ####################################################
+    ##########################################################################
+
+    def _axes(self, n, tile):
+        """
+        Start and size in pixels of the n subplot axes along one side
+        of the grid, measured from the edge of the tile area
+        """
+        size = n * tile / (n + self.space * (n - 1))
+        start = np.arange(n) * size * (1 + self.space)
+        return start, size
+
+    def mask(self, height, width):
+        """
+        (height, width) array of the camera pixel drawn at each output
+        pixel of a subplot, -1 for background
+        """
+        key = (height, width)
+        if key not in self._masks:
+            b = self.bounds
+            x = -b + (np.arange(width) + .5) / width * 2 * b
+            y = b - (np.arange(height) + .5) / height * 2 * b
+            x, y = np.meshgrid(x, y)
+            x = x.ravel()
+            y = y.ravel()
+
+            # Hexagons tile the plane as the Voronoi cells of their
+            # centres, so the nearest centre is the only candidate
+            cx, cy = Camera.unit_xy()
+            nearest = np.empty(len(x), dtype='int64')
+            for a in range(0, len(x), 4096):
+                d = (x[a:a+4096, np.newaxis] - cx)**2 + \
+                    (y[a:a+4096, np.newaxis] - cy)**2
+                nearest[a:a+4096] = d.argmin(axis=1)
+
+            # Pointed top hexagons of unit side length
+            dx = np.abs(x - cx[nearest])
+            dy = np.abs(y - cy[nearest])
+            inside = (dx <= math.sqrt(3)/2) & (dy <= 1 - dx/math.sqrt(3))
+            mask = np.where(inside, nearest, -1).reshape(height, width)
+
+            mask.setflags(write=False)
+            self._masks[key] = mask
+        return self._masks[key]
+
+    def colors(self, charge):
+        """
+        (499 + 1, 3) uint8 colours of each camera pixel, scaled to the
+        subject's charge range like matplotlib, with white last for
+        the background
+        """
+        charge = np.asarray(charge, dtype='float64')
+        lo = charge.min()
+        hi = charge.max()
+        if hi > lo:
+            norm = (charge - lo) / (hi - lo)
+        else:
+            norm = np.zeros_like(charge)
+
+        colors = np.full((len(charge) + 1, 3), 255, dtype='uint8')
+        colors[:-1] = np.round(self.cmap(norm)[:, :3] * 255)
+        return colors
+
+    def draw_tile(self, charge, mask):
+        """
+        (height, width, 3) image of one subject drawn with mask
+        """
+        if self.cache is None:
+            return self.colors(charge)[mask]
+
+        key = self.cache.key(charge, self.cmap.name, mask.shape)
+        return self.cache.get(key, lambda: self.colors(charge)[mask])
+
+    ##########################################################################
+    ###   Text   #############################################################
+    ##########################################################################
+
+    def glyph(self, text):
+        """
+        Coverage in [0, 1] of the rendered text, and the offset of its
+        top left corner from the baseline origin
+        """
+        if text not in self._glyphs:
+            size = self.fontsize * self.dpi / 72.
+            path = TextPath((0, 0), text, size=size)
+            extents = path.get_extents()
+            x0 = int(math.floor(extents.x0))
+            y1 = int(math.ceil(extents.y1))
+            width = int(math.ceil(extents.x1)) - x0
+            height = y1 - int(math.floor(extents.y0))
+
+            # Four samples per pixel in each direction for antialiasing
+            n = 4
+            sx = x0 + (np.arange(width * n) + .5) / n
+            sy = y1 - (np.arange(height * n) + .5) / n
+            sx, sy = np.meshgrid(sx, sy)
+            points = np.stack([sx.ravel(), sy.ravel()], axis=1)
+
+            # Glyph outlines are filled even-odd, so holes in letters
+            # like B stay empty
+            inside = np.zeros(len(points), dtype=bool)
+            for polygon in path.to_polygons():
+                inside ^= Path(polygon).contains_points(points)
+            inside = inside.reshape(height * n, width * n)
+            coverage = inside.reshape(height, n, width, n).mean(axis=(1, 3))
+
+            self._glyphs[text] = (coverage, (-y1, x0))
+        return self._glyphs[text]
+
+    def _text(self, buffer, text, x, y):
+        """
+        Draw black text with its baseline origin at pixel x, y
+        """
+        coverage, (dy, dx) = self.glyph(text)
+        top = int(round(y)) + dy
+        left = int(round(x)) + dx
+        h, w = coverage.shape
+
+        # Clip to the buffer
+        a0 = max(0, -top)
+        b0 = max(0, -left)
+        a1 = min(h, buffer.shape[0] - top)
+        b1 = min(w, buffer.shape[1] - left)
+        if a1 <= a0 or b1 <= b0:
+            return
+
+        region = buffer[top+a0:top+a1, left+b0:left+b1]
+        c = coverage[a0:a1, b0:b1, np.newaxis]
+        region[:] = np.round(region * (1 - c))
+
+    ##########################################################################
+    ###   Rendering   ########################################################
+    ##########################################################################
+
+    def render(self, charges, cols):
+        """
+        Render subject charges in a grid cols wide, row by row from the
+        top left
+
+        charges: (N, 499) array
+
+        Returns the (H, W, 3) uint8 image and the figure metadata
+        Image.at_location uses
+        """
+        charges = np.asarray(charges)
+        geometry = self.geometry(len(charges), cols)
+        rows = geometry.rows
+        left, top = geometry.origin
+        left = int(round(left))
+        top = int(round(top))
+        tile_w, tile_h = geometry.tile
+        height, width = geometry.shape
+        buffer = np.full((height, width, 3), 255, dtype='uint8')
+
+        x0, w = self._axes(cols, tile_w)
+        y0, h = self._axes(rows, tile_h)
+        mask = self.mask(int(round(h)), int(round(w)))
+
+        for i, charge in enumerate(charges):
+            y = top + int(round(y0[i // cols]))
+            x = left + int(round(x0[i % cols]))
+            tile = self.draw_tile(charge, mask)
+            buffer[y:y+mask.shape[0], x:x+mask.shape[1]] = tile
+
+        # Grid lines, black at .6 alpha and 1.5 points wide
+        gray = int(round(255 * .4))
+        line = max(1, int(round(1.5 * self.dpi / 72.)))
+        for i in range(1, rows):
+            y = top + int(round(i * tile_h)) - line // 2
+            buffer[y:y+line, left:] = gray
+        for i in range(1, cols):
+            x = left + int(round(i * tile_w)) - line // 2
+            buffer[top:, x:x+line] = gray
+
+        # Row numbers and column letters, placed like _plot_add_grid
+        offset = left
+        for i in range(rows):
+            y = top + (i + .5) * tile_h
+            self._text(buffer, str(i + 1), offset / 2, y)
+        for i in range(cols):
+            x = ((2*i + 1) / 2 / cols * (1 - offset / width) + .02) * width
+            y = offset * 2 / 3
+            self._text(buffer, string.ascii_uppercase[i], x, y)
+
+        return buffer, geometry.metadata()
+
+    def save(self, fname, charges, cols):
+        """
+        Render a grid and write it to a png file
+
+        Returns the figure metadata
+        """
+        buffer, meta = self.render(charges, cols)
+        matplotlib.image.imsave(fname, buffer, dpi=self.dpi)
+        return meta
+
+
+class TileCache:
+    """
+    Persistent cache of rendered subject tiles, keyed by a hash of the
+    subject's charges, the colormap and the tile size, so a subject
+    shown in several images or groups is drawn once.
+
+    Tiles are stored as .npy files in one directory. Reading a tile
+    touches its modification time, and the least recently used tiles
+    are deleted when the directory grows past budget bytes. Several
+    processes can share a directory. Each process re-reads the size of
+    the directory as it writes, to see the tiles written by the others,
+    and worker processes report their counts with take_counts.
+    """
+
+    # Eviction frees space down to this fraction of the budget, so the
+    # directory is not scanned again on every new tile
+    low = .9
+    # Fraction of the space freed by eviction a process writes before
+    # it re-reads the size of the directory
+    restat = 1 / 16.
+
+    def __init__(self, path, budget=2**30):
+        self.path = os.path.abspath(path)
+        self.budget = budget
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh()
+
+    def _files(self):
+        return [f for f in os.scandir(self.path)
+                if f.name.endswith('.npy')]
+
+    def refresh(self):
+        """
+        Re-read the size of the directory
+        """
+        size = 0
+        for f in self._files():
+            try:
+                size += f.stat().st_size
+            except OSError:
+                # Evicted by another process
+                pass
+        self.size = size
+        self._written = 0
+
+    @staticmethod
+    def key(charge, cmap, shape):
+        charge = np.ascontiguousarray(charge, dtype='float64')
+        h = hashlib.sha1(charge.tobytes())
+        h.update(('%s %s' % (cmap, tuple(shape))).encode())
+        return h.hexdigest()
+
+    def get(self, key, build):
+        """
+        Cached tile for key, calling build to render and store it
+        on a miss
+        """
+        fname = os.path.join(self.path, key + '.npy')
+        try:
+            tile = np.load(fname)
+            os.utime(fname)
+            self.hits += 1
+            return tile
+        except (IOError, ValueError):
+            pass
+
+        self.misses += 1
+        tile = build()
+
+        # Write to a temporary file first so other processes never read
+        # a partial tile
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, tile)
+        os.replace(tmp, fname)
+
+        length = os.path.getsize(fname)
+        self.size += length
+        self._written += length
+        if self._written > self.restat * (1 - self.low) * self.budget:
+            self.refresh()
+        if self.size > self.budget:
+            self.evict()
+        return tile
+
+    def evict(self):
+        """
+        Delete least recently used tiles until the cache is below
+        low * budget
+        """
+        files = []
+        for f in self._files():
+            try:
+                stat = f.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, f.path))
+        files.sort()
+
+        size = sum(f[1] for f in files)
+        for _, length, fname in files:
+            if size <= self.low * self.budget:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                # Already evicted by another process
+                pass
+            else:
+                self.evictions += 1
+            size -= length
+        self.size = size
+        self._written = 0
+
+    def take_counts(self):
+        """
+        Hits, misses and evictions since the last call, which are then
+        reset, for worker processes to report to the parent
+        """
+        counts = {'hits': self.hits, 'misses': self.misses,
+                  'evictions': self.evictions}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        return counts
+
+    def add_counts(self, counts):
+        self.hits += counts['hits']
+        self.misses += counts['misses']
+        self.evictions += counts['evictions']
+
+    def info(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reuse': self.hits / requests if requests else 0.,
+            'evictions': self.evictions,
+            'size': self.size,
+            'budget': self.budget,
+        }
@@ -0,0 +1,279 @@
+
+import os
+import json
+import sqlite3
+
+
+class StructureStore:
+    """
+    SQLite store of image groups, their images, the subjects in each
+    image and the id counters.
+
+    Every write is one transaction, and saving a group only touches the
+    rows of that group, instead of rewriting the whole structure file.
+    Images are indexed by group and zooniverse id, and image membership
+    by subject.
+    """
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS counters ('
+        '    name TEXT PRIMARY KEY,'
+        '    value INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS groups ('
+        '    id INTEGER PRIMARY KEY,'
+        '    metadata TEXT NOT NULL)',
+        # zoo_id has no type affinity, so ids keep their python type
+        'CREATE TABLE IF NOT EXISTS images ('
+        '    id INTEGER PRIMARY KEY,'
+        '    group_id INTEGER NOT NULL,'
+        '    zoo_id,'
+        '    deleted INTEGER NOT NULL DEFAULT 0,'
+        '    metadata TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS images_group ON images (group_id)',
+        'CREATE INDEX IF NOT EXISTS images_zoo ON images (zoo_id)',
+        'CREATE TABLE IF NOT EXISTS image_subjects ('
+        '    image_id INTEGER NOT NULL,'
+        '    position INTEGER NOT NULL,'
+        '    subject INTEGER NOT NULL,'
+        '    PRIMARY KEY (image_id, position))',
+        'CREATE INDEX IF NOT EXISTS image_subjects_subject '
+        '    ON image_subjects (subject)',
+    ]
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.conn = sqlite3.connect(fname)
+        with self.conn:
+            for statement in self.schema:
+                self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+    def backup(self, fname):
+        """
+        Copy the store to another database file
+        """
+        dest = sqlite3.connect(fname)
+        with dest:
+            self.conn.backup(dest)
+        dest.close()
+
+    ##########################################################################
+    ###   Groups   ###########################################################
+    ##########################################################################
+
+    def groups(self):
+        cursor = self.conn.execute('SELECT id FROM groups ORDER BY id')
+        return [row[0] for row in cursor]
+
+    def has_group(self, group):
+        cursor = self.conn.execute(
+            'SELECT 1 FROM groups WHERE id = ?', (group,))
+        return cursor.fetchone() is not None
+
+    def load_group(self, group):
+        """
+        Metadata and image dumps of a group, in the format of
+        Image.dump
+
+        Returns None if the group is not in the store
+        """
+        cursor = self.conn.execute(
+            'SELECT metadata FROM groups WHERE id = ?', (group,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        metadata = json.loads(row[0])
+
+        cursor = self.conn.execute(
+            'SELECT id, zoo_id, metadata FROM images '
+            'WHERE group_id = ? ORDER BY id', (group,))
+        images = []
+        for id_, zoo_id, meta in cursor:
+            images.append({
+                'id': id_,
+                'group': group,
+                'subjects': [],
+                'metadata': json.loads(meta),
+                'zooniverse_id': zoo_id,
+            })
+
+        subjects = {}
+        cursor = self.conn.execute(
+            'SELECT s.image_id, s.subject FROM image_subjects AS s '
+            'JOIN images AS i ON i.id = s.image_id '
+            'WHERE i.group_id = ? ORDER BY s.image_id, s.position', (group,))
+        for image_id, subject in cursor:
+            subjects.setdefault(image_id, []).append(subject)
+
+        for image in images:
+            image['subjects'] = subjects.get(image['id'], [])
+
+        return metadata, images
+
+    def save_group(self, group, metadata, images, overwrite=False):
+        """
+        Store a group and its images
+
+        images: list of image dumps, in the format of Image.dump
+        overwrite: replace the group if it is already stored
+
+        Images are updated in place, and images no longer in the group
+        are removed from it
+        """
+        with self.conn:
+            if self.has_group(group) and not overwrite:
+                raise Exception('Refusing to overwrite group (%s) in '
+                                'structure store' % group)
+
+            self.conn.execute(
+                'INSERT OR REPLACE INTO groups (id, metadata) VALUES (?, ?)',
+                (group, json.dumps(metadata)))
+
+            ids = [image['id'] for image in images]
+            keep = set(ids)
+            cursor = self.conn.execute(
+                'SELECT id FROM images WHERE group_id = ?', (group,))
+            stale = [(row[0],) for row in cursor if row[0] not in keep]
+            self.conn.executemany(
+                'DELETE FROM image_subjects WHERE image_id = ?', stale)
+            self.conn.executemany('DELETE FROM images WHERE id = ?', stale)
+
+            for image in images:
+                self._save_image(image)
+
+            if ids:
+                self._bump('next_id', max(ids) + 1)
+            self._bump('next_group', group + 1)
+
+    def update_image(self, image):
+        """
+        Store a single image dump, leaving the rest of its group as is
+        """
+        with self.conn:
+            self._save_image(image)
+            self._bump('next_id', image['id'] + 1)
+
+    def _save_image(self, image):
+        metadata = image['metadata']
+        self.conn.execute(
+            'INSERT OR REPLACE INTO images '
+            '(id, group_id, zoo_id, deleted, metadata) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (image['id'], image['group'], image['zooniverse_id'],
+             int(metadata.get('deleted') is True), json.dumps(metadata)))
+
+        self.conn.execute(
+            'DELETE FROM image_subjects WHERE image_id = ?', (image['id'],))
+        self.conn.executemany(
+            'INSERT INTO image_subjects (image_id, position, subject) '
+            'VALUES (?, ?, ?)',
+            [(image['id'], i, int(s))
+             for i, s in enumerate(image['subjects'])])
+
+    ##########################################################################
+    ###   Lookups   ##########################################################
+    ##########################################################################
+
+    def image_by_zoo(self, zoo_id):
+        """
+        (group, image id) of the image uploaded as zoo_id, or None
+        """
+        cursor = self.conn.execute(
+            'SELECT group_id, id FROM images WHERE zoo_id = ?', (zoo_id,))
+        return cursor.fetchone()
+
+    def images_of_subject(self, subject):
+        """
+        Ids of the images showing a subject
+        """
+        cursor = self.conn.execute(
+            'SELECT DISTINCT image_id FROM image_subjects '
+            'WHERE subject = ? ORDER BY image_id', (int(subject),))
+        return [row[0] for row in cursor]
+
+    ##########################################################################
+    ###   Counters   #########################################################
+    ##########################################################################
+
+    def counters(self):
+        """
+        Next group and next image id to assign
+        """
+        cursor = self.conn.execute('SELECT name, value FROM counters')
+        counters = dict(cursor.fetchall())
+        return counters.get('next_group', 0), counters.get('next_id', 0)
+
+    def update_counters(self, next_group, next_id):
+        """
+        Raise the counters to at least next_group and next_id
+        """
+        with self.conn:
+            self._bump('next_group', next_group)
+            self._bump('next_id', next_id)
+        return self.counters()
+
+    def _bump(self, name, value):
+        self.conn.execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET '
+            'value = MAX(value, excluded.value)', (name, int(value)))
+
+    ##########################################################################
+    ###   JSON   #############################################################
+    ##########################################################################
+
+    def import_json(self, fname, overwrite=False):
+        """
+        Copy every group of a structure json file into the store,
+        in one transaction
+
+        Returns the number of groups imported
+        """
+        with open(fname, 'r') as file:
+            data = json.load(file)
+
+        with self.conn:
+            for group, item in data['groups'].items():
+                group = int(group)
+                if self.has_group(group) and not overwrite:
+                    raise Exception('Refusing to overwrite group (%s) in '
+                                    'structure store' % group)
+
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO groups (id, metadata) '
+                    'VALUES (?, ?)', (group, json.dumps(item['metadata'])))
+                for image in item['images']:
+                    self._save_image(image)
+
+            self._bump('next_group', data.get('next_group', 0))
+            self._bump('next_id', data.get('next_id', 0))
+
+        print('Imported %d groups from %s' % (len(data['groups']), fname))
+        return len(data['groups'])
+
+    @classmethod
+    def from_json(cls, fname):
+        """
+        In memory store holding the contents of a structure json file
+        """
+        store = cls(':memory:')
+        store.import_json(fname)
+        return store
+
+    def export_json(self, fname):
+        """
+        Write the store in the old structure json format
+        """
+        next_group, next_id = self.counters()
+        data = {'next_group': next_group, 'next_id': next_id, 'groups': {}}
+        for group in self.groups():
+            metadata, images = self.load_group(group)
+            data['groups'][str(group)] = {
+                'metadata': metadata, 'images': images}
+
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp, fname)
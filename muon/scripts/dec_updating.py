@@ -10,6 +10,7 @@ from keras import optimizers
 from muon.deep_clustering.clustering import Config, Cluster
 from muon.deep_clustering.mapping2 import Mapping
 from muon.deep_clustering.dec_updating import DEC_Updater
+from muon.utils.subjects import Subjects
 import muon.deep_clustering.utils as utils
 import muon.project.parse_export as pe
 
@@ -28,7 +29,7 @@ validate = utils.load_set('mnt/training_set/test.csv')
 def main(path, name, lr):
     config = Config.load(_config)
     print(config.__dict__)
-    subjects = pickle.load(open(config.subjects, 'rb'))
+    subjects = Subjects.load(config.subjects)
 
     labels = pe.Aggregate.load('mh2')
     truth = pe.Aggregate.load('mh2_gold')
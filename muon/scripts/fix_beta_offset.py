@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from muon.project.images import Images
+from muon.project.geometry import ImageGeometry
 import math
 
 
@@ -11,17 +12,8 @@ def main():
             N = len(image.subjects)
             cols = 10
             rows = math.ceil(N/10)
-            image.metadata.update({
-                'figure': {
-                    'cols': cols,
-                    'rows': rows,
-                    'height': 2*rows,
-                    'width': 2*cols,
-                    'dpi': 100,
-                    'offset': 0.03*(2*cols),
-                    'beta_image': True,
-                }
-            })
+            geometry = ImageGeometry.beta(rows, cols)
+            image.metadata.update({'figure': geometry.metadata()})
 
         images.save_group(overwrite=True)
 
@@ -27,7 +27,7 @@ validate = utils.load_set('mnt/training_set/test.csv')
 def main(path, name):
     config = Config.load(_config)
     print(config.__dict__)
-    subjects = pickle.load(open(config.subjects, 'rb'))
+    subjects = Subjects.load(config.subjects)
 
     labels = pe.Aggregate.load('mh2')
     truth = pe.Aggregate.load('mh2_gold')
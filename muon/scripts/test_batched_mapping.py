@@ -17,7 +17,7 @@ logger = logging.getLogger(__name__)
 config = 'mnt/dec/dec_no_labels/config_jupyter.json'
 config = Config.load(config)
 print(config.__dict__)
-subjects = pickle.load(open(config.subjects, 'rb'))
+subjects = Subjects.load(config.subjects)
 # cluster = Cluster.create(subjects, config)
 
 import muon.project.parse_export as pe
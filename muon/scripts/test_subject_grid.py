@@ -9,7 +9,7 @@ def main():
     fname = os.path.join(
         os.getenv('MUOND'), 'Data/test_subjects.pkl')
     print('fname: %s' % fname)
-    subjects = pickle.load(open(fname, 'rb'))
+    subjects = Subjects.load(fname)
     sample = subjects._sample_s(100)
 
     fig = sample.plot_subjects(w=10, grid=True)
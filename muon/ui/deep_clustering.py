@@ -33,8 +33,7 @@ def run(output, subjects, ae_weights, clusters):
 
     # subjects = Subjects.from_data(path)
     fname = subjects
-    with open(subjects, 'rb') as file:
-        subjects = pickle.load(file)
+    subjects = Subjects.load(subjects)
     logger.info('Done loading subjects')
 
     config = Config(**{
@@ -67,7 +66,7 @@ def run(output, subjects, ae_weights, clusters):
 @click.argument('config', nargs=1)
 def load(config):
     config = Config.load(config)
-    subjects = pickle.load(open(config.subjects, 'rb'))
+    subjects = Subjects.load(config.subjects)
     cluster = Cluster.create(subjects, config)
 
     logger.info('Training model')
@@ -83,7 +82,7 @@ def load(config):
 @click.option('--new', is_flag=True)
 def test(config, new):
     config = Config.load(config)
-    subjects = pickle.load(open(config.subjects, 'rb'))
+    subjects = Subjects.load(config.subjects)
     cluster = Cluster.create(subjects, config)
 
     logger.info('Training model')
@@ -1,7 +1,10 @@
 
 from muon.ui import ui
+from muon.utils.subjects import Subjects
 from muon.deep_clustering.clustering import Config, Cluster
 from muon.project.images import Images, Random_Images
+from muon.project.render import GridRenderer, TileCache
+from muon.project.structure import StructureStore
 import muon.project.parse_export as pe
 import muon.project.panoptes as panoptes
 import muon.config
@@ -31,7 +34,7 @@ def interact(local):
 @images.command()
 @click.argument('subjects', nargs=1)
 def test(subjects):
-    subjects = pickle.load(open(subjects, 'rb'))
+    subjects = Subjects.load(subjects)
     images = Images.new(subjects)
     interact(locals())
 
@@ -44,7 +47,7 @@ def test(subjects):
 @click.option('--save', is_flag=True)
 def new(config, width, size, permutations, save):
     config = Config.load(config)
-    subjects = pickle.load(open(config.subjects, 'rb'))
+    subjects = Subjects.load(config.subjects)
     cluster = Cluster.create(subjects, config)
 
     logger.info('Training model')
@@ -71,13 +74,30 @@ def new(config, width, size, permutations, save):
 @click.argument('config', nargs=1)
 @click.argument('group', type=int)
 @click.option('--path')
-def generate(config, group, path):
+@click.option('--fast', is_flag=True,
+              help='Render images with numpy instead of matplotlib')
+@click.option('--workers', type=int, default=1,
+              help='Number of processes to render images in')
+@click.option('--tile-cache',
+              help='Directory of cached subject tiles for --fast')
+@click.option('--tile-budget', type=int, default=2**30,
+              help='Disk budget in bytes of the tile cache')
+def generate(config, group, path, fast, workers, tile_cache, tile_budget):
     config = Config.load(config)
-    subjects = pickle.load(open(config.subjects, 'rb'))
+    subjects = Subjects.load(config.subjects)
+
+    renderer = None
+    if fast:
+        cache = None
+        if tile_cache:
+            cache = TileCache(tile_cache, tile_budget)
+        renderer = GridRenderer(cache=cache)
 
     images = Random_Images.load_group(group)
-    images.generate_images(subjects, path)
+    images.generate_images(subjects, path, renderer, workers)
     images.save_group(overwrite=True)
+    if renderer is not None and renderer.cache is not None:
+        print('Tile cache: %s' % renderer.cache.info())
 
     interact(locals())
 
@@ -89,7 +109,7 @@ def generate(config, group, path):
 def load(group, config, structure):
     if config:
         config = Config.load(config)
-        subjects = pickle.load(open(config.subjects, 'rb'))
+        subjects = Subjects.load(config.subjects)
 
     if structure:
         images = Random_Images.load_group(group, fname=structure)
@@ -133,6 +153,19 @@ def list():
     print(' '.join(groups))
 
 
+@images.command()
+@click.argument('fname', required=False)
+@click.option('--overwrite', is_flag=True)
+def import_structure(fname, overwrite):
+    if fname is None:
+        fname = Images._json_fname()
+    # Open the store directly, as Images._store would import the host's
+    # json file on its own the first time
+    store = StructureStore(Images._fname())
+    store.import_json(fname, overwrite)
+    store.close()
+
+
 @images.command()
 @click.argument('name')
 @click.argument('groups')
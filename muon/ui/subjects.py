@@ -1,6 +1,7 @@
 
 from muon.ui import ui
-from muon.utils.subjects import Subjects, Subject_Data, Subject
+from muon.utils.subjects import Subjects, Subject_Data, Subject, \
+    Columnar_Data
 from muon.utils.camera import Camera, CameraPlot, CameraRotate
 
 import os
@@ -45,27 +46,50 @@ def interact(local):
 @subjects.command()
 @click.argument('fname', nargs=1)
 @click.argument('data', nargs=1)
-def save(fname, data):
-    subjects = Subjects.from_data(data)
-    pickle.dump(subjects, open(fname, 'wb'))
+@click.option('--mapped', is_flag=True,
+              help='Save a memory mapped subject store directory')
+def save(fname, data, mapped):
+    if mapped and Columnar_Data.is_columnar(data):
+        Columnar_Data(data).export(fname)
+    elif mapped:
+        Subjects.from_data(data).save_mapped(fname)
+    else:
+        subjects = Subjects.from_data(data)
+        pickle.dump(subjects, open(fname, 'wb'))
 
 
 @subjects.command()
 @click.argument('fname', nargs=1)
 def load(fname):
-    subjects = pickle.load(open(fname, 'rb'))
+    subjects = Subjects.load(fname)
     interact(locals())
 
 
 @subjects.command()
 @click.argument('output', nargs=1)
 @click.argument('raw', nargs=-1)
-def generate(output, raw):
-    sd = Subject_Data(output)
-    sd.load_raw(raw)
+@click.option('--layout', type=click.Choice(['columnar', 'groups']),
+              default='columnar')
+@click.option('--workers', type=int, default=1,
+              help='Number of processes decoding raw files')
+def generate(output, raw, layout, workers):
+    if layout == 'columnar':
+        sd = Columnar_Data(output)
+        sd.load_raw(raw, workers)
+    else:
+        sd = Subject_Data(output)
+        sd.load_raw(raw)
     sd.close()
 
 
+@subjects.command()
+@click.argument('source', nargs=1)
+@click.argument('output', nargs=1)
+@click.option('--overwrite', is_flag=True)
+def convert(source, output, overwrite):
+    Columnar_Data.convert(source, output, overwrite)
+
+
 @subjects.command()
 def test():
     from muon.utils.subjects import Subject_Data
@@ -80,7 +104,7 @@ def test():
 def test_rotation(subject, subjects_file):
     subject = int(subject)
     import pickle
-    # subjects = pickle.load(open(subjects_file, 'rb'))
+    # subjects = Subjects.load(subjects_file)
 
     # s2 = subjects._sample_s(10)
 
@@ -121,7 +145,7 @@ def test_rotation(subject, subjects_file):
 def subject_rotation(subject, subjects_file):
     subject = int(subject)
     import pickle
-    subjects = pickle.load(open(subjects_file, 'rb'))
+    subjects = Subjects.load(subjects_file)
 
     s2 = subjects._sample_s(10)
 
@@ -28,8 +28,7 @@ def interact(local):
 
 def load_subjects(config):
     fname = config.subjects
-    with open(fname, 'rb') as file:
-        subjects = pickle.load(file)
+    subjects = Subjects.load(fname)
     logger.info('Done loading subjects')
 
     agg = pe.Aggregate.load(config.label_source)
@@ -1,48 +1,114 @@
 
 import math
-import pickle
-import os
 import numpy as np
+import scipy.sparse
 import matplotlib.pyplot as plt
 from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
+from matplotlib.collections import PolyCollection
 
-import muon.data
 import muon.config
 
 
 class Camera:
 
+    # (2, 499) pixel coordinates for a unit side length and the pixel
+    # adjacency matrix, computed once and shared by every Camera
+    _unit_xy = None
+    _adjacency = None
+
     def __init__(self, length=None):
         # hexagon pixel side length
         self.pixSideLength = length or 1.
         self.numCamSpirals = 13
 
+        self._xy = None
         self._coordinates = None
 
+    @classmethod
+    def unit_xy(cls):
+        if cls._unit_xy is None:
+            _, x, y = zip(*cls(1.).map_coordinates())
+            xy = np.array([x, y])
+            xy.setflags(write=False)
+            cls._unit_xy = xy
+        return cls._unit_xy
+
+    @property
+    def xy(self):
+        """
+        (2, 499) array of pixel x and y coordinates
+        """
+        if self._xy is None:
+            xy = self.unit_xy() * self.pixSideLength
+            xy.setflags(write=False)
+            self._xy = xy
+        return self._xy
+
+    @property
+    def x(self):
+        return self.xy[0]
+
+    @property
+    def y(self):
+        return self.xy[1]
+
+    @property
+    def adjacency(self):
+        """
+        (499, 499) sparse CSR matrix, 1 where two pixels share an edge
+        """
+        cls = self.__class__
+        if cls._adjacency is None:
+            xy = cls.unit_xy()
+            d = np.hypot(*(xy[:, :, np.newaxis] - xy[:, np.newaxis, :]))
+            # Neighbouring centres are sqrt(3) side lengths apart
+            a = np.isclose(d, math.sqrt(3), atol=.05)
+            cls._adjacency = scipy.sparse.csr_matrix(a, dtype='int8')
+        return cls._adjacency
+
+    @property
+    def neighbours(self):
+        """
+        (499, 6) array of neighbouring pixels, padded with -1 for
+        pixels on the edge of the camera
+        """
+        adjacency = self.adjacency
+        table = np.full((adjacency.shape[0], 6), -1, dtype='int64')
+        for i in range(adjacency.shape[0]):
+            row = adjacency.indices[
+                adjacency.indptr[i]:adjacency.indptr[i+1]]
+            table[i, :len(row)] = row
+        return table
+
     @property
     def coordinates(self):
         if self._coordinates is None:
-            raw = self.map_coordinates()
             coordinates = {}
-
-            for i, x, y in raw:
-                coordinates[i] = (x, y)
+            for i, (x, y) in enumerate(self.xy.T.tolist()):
+                coordinates[i+1] = (x, y)
 
             self._coordinates = coordinates
 
         return self._coordinates
 
     def transform(self, charges, split=True):
-        data = []
-        for i, c in enumerate(charges):
-            x, y = self.coordinates[i+1]
-            data.append((x, y, c))
+        """
+        Pair pixel charges with pixel locations
+
+        charges: (width,) charges of one subject, or (N, width)
+                 for a batch of subjects
+
+        If split, returns x, y, c arrays shaped like charges. Otherwise
+        returns one (..., width, 3) array of x, y, c triples.
+        """
+        c = np.asarray(charges)
+        width = c.shape[-1]
+        x = np.broadcast_to(self.x[:width], c.shape)
+        y = np.broadcast_to(self.y[:width], c.shape)
 
         if split:
-            x, y, c = zip(*data)
             return x, y, c
-        return data
+        return np.stack([x, y, c], axis=-1)
 
     def map_coordinates(self):
         deltaX = math.sqrt(3) * self.pixSideLength / 2.
@@ -135,10 +201,21 @@ class Camera:
 
 
 class CameraRotate:
+    """
+    Pixel permutations for rotating the camera in steps of 60 degrees,
+    and for the reflections that complete its 12 element symmetry group.
+
+    The permutations are derived from the pixel lattice in memory, so
+    nothing is read from or written to disk. data_dir is accepted for
+    compatibility and ignored.
+    """
+
+    # (6, 499) rotation and (12, 499) symmetry indices, computed once
+    # and shared by every CameraRotate
+    _rotations = None
+    _symmetry = None
 
     def __init__(self, data_dir=None):
-        if data_dir is None:
-            data_dir = muon.data.dir()
         self.data_dir = data_dir
         self.camera = Camera()
 
@@ -146,31 +223,152 @@ class CameraRotate:
 
     @property
     def data(self):
+        """
+        Rotation maps in the original format, {n: {pixel: pixel}}
+        with one based pixel numbers
+        """
         if self._data is None:
-            if self.data_dir is None:
-                data = self.create_map()
-            else:
-                fname = os.path.join(self.data_dir, 'camera_rotate.pkl')
-                if os.path.isfile(fname):
-                    data = pickle.load(open(fname, 'rb'))
-                else:
-                    data = self.create_map()
-                    with open(fname, 'wb') as file:
-                        pickle.dump(data, file)
-
+            data = {}
+            for n in range(1, 6):
+                index = self.index[n]
+                data[n] = {int(i)+1: j+1 for j, i in enumerate(index)}
             self._data = data
         return self._data
 
+    @property
+    def index(self):
+        """
+        (6, 499) array of pixel indices for each rotation, so that
+        charge[..., index[n]] is the charge rotated n times
+        """
+        cls = self.__class__
+        if cls._rotations is None:
+            index = np.zeros((6, len(Camera.unit_xy()[0])), dtype='int64')
+            for n in range(6):
+                t = -math.pi*n/3
+                index[n] = self.permutation([[math.cos(t), -math.sin(t)],
+                                             [math.sin(t), math.cos(t)]])
+            index.setflags(write=False)
+            cls._rotations = index
+        return cls._rotations
+
+    @property
+    def symmetry(self):
+        """
+        (12, 499) array of pixel indices for the camera symmetry group.
+        index[n] for n < 6 rotates n times, index[6+n] mirrors x and
+        then rotates n times.
+        """
+        cls = self.__class__
+        if cls._symmetry is None:
+            mirror = self.permutation([[-1, 0], [0, 1]])
+            index = np.concatenate([self.index, mirror[self.index]])
+            index.setflags(write=False)
+            cls._symmetry = index
+        return cls._symmetry
+
+    def group(self, rotation):
+        """
+        Index arrays for a rotation option: True for the six rotations,
+        'reflect' for all twelve rotations and reflections
+        """
+        if rotation == 'reflect':
+            return self.symmetry
+        if rotation:
+            return self.index
+        return self.index[:1]
+
+    @staticmethod
+    def permutation(matrix):
+        """
+        Pixel index for a linear map of the camera plane onto itself,
+        so that charge[..., index] is the transformed charge.
+
+        Pixel centres sit on a lattice with steps of sqrt(3)/2 in x and
+        3/2 in y, so each transformed centre is matched to a pixel by
+        rounding to its lattice position.
+        """
+        xy = Camera.unit_xy()
+        step = np.array([[math.sqrt(3)/2.], [3./2.]])
+
+        def keys(xy):
+            i, j = np.rint(xy / step).astype('int64') + 64
+            return i * 128 + j
+
+        pixels = keys(xy)
+        order = np.argsort(pixels)
+        moved = keys(np.dot(np.asarray(matrix, dtype='float64'), xy))
+
+        pos = np.searchsorted(pixels, moved, sorter=order)
+        index = order[np.minimum(pos, len(order)-1)]
+        if (pixels[index] != moved).any():
+            raise Exception('Unmapped pixels found in rotation')
+        return index
+
     def rotate(self, coords, n):
+        """
+        Apply symmetry n, a rotation for n < 6 and a reflection
+        for 6 <= n < 12
+        """
         if n == 0:
             return coords
 
-        new = np.zeros_like(coords)
-        for i in self.data[n]:
-            j = self.data[n][i]
-            new[j-1] = coords[i-1]
-
-        return new
+        return np.asarray(coords)[..., self.symmetry[n]]
+
+    def rotate_many(self, charges, rotations=None):
+        """
+        Rotate a batch of charges with one indexing operation
+
+        charges: (N, 499) array
+        rotations: symmetries to apply, the six rotations by default.
+                   Numbers 6 to 11 are reflections.
+
+        Returns (N*len(rotations), 499) with the rotations of
+        each subject next to each other
+        """
+        if rotations is None:
+            rotations = range(6)
+        index = self.symmetry[list(rotations)]
+        charges = np.asarray(charges)
+        return charges[:, index].reshape(-1, charges.shape[1])
+
+    def canonical(self, charges, reflect=True, chunk=4096):
+        """
+        Map each subject to the same representative for every
+        orientation: the transformed copy that is lexicographically
+        smallest in pixel order. Symmetric charges tie, and resolve to
+        the lowest symmetry number.
+
+        charges: (N, 499) array
+        reflect: use reflections as well as rotations
+
+        Returns the (N, 499) canonical charges and the (N,) symmetry
+        that was applied to each subject
+        """
+        index = self.group('reflect' if reflect else True)
+        charges = np.asarray(charges)
+        out = np.empty_like(charges)
+        which = np.zeros(len(charges), dtype='int64')
+
+        for a in range(0, len(charges), chunk):
+            b = min(len(charges), a + chunk)
+            c = charges[a:b][:, index]
+            n = np.arange(b - a)
+
+            # Compare pixel by pixel, dropping candidates that are larger,
+            # until each subject has one candidate left
+            alive = np.ones(c.shape[:2], dtype=bool)
+            for k in range(c.shape[2]):
+                if (alive.sum(axis=1) == 1).all():
+                    break
+                col = np.where(alive, c[:, :, k], np.inf)
+                alive &= col == col.min(axis=1, keepdims=True)
+
+            g = alive.argmax(axis=1)
+            out[a:b] = c[n, g]
+            which[a:b] = g
+
+        return out, which
 
 
     ##########################################################################
@@ -178,6 +376,10 @@ class CameraRotate:
     ##########################################################################
 
     def create_map(self):
+        """
+        Reference rotation maps from a search over polar coordinates,
+        used to validate the lattice permutations
+        """
         data = {}
         for n in range(1, 6):
             data[n] = self._rotate(n)
@@ -212,20 +414,26 @@ class CameraRotate:
         for i in range(coords.shape[0]):
             a = np.isclose(rotated, coords[i], atol=.05).all(axis=1)
             if a.any():
-                new[i] = np.where(a == True)[0]
+                new[i] = np.where(a)[0][0]
             else:
                 new[i] = -1
 
         if -1 in new:
             raise Exception('Unmapped pixels found in rotation')
 
-        print(new)
-
         out = {}
         for i, k in enumerate(keys):
             out[k] = int(new[i]) + 1
         return out
 
+    def validate(self):
+        """
+        Check the lattice permutations against create_map
+        """
+        if self.create_map() != self.data:
+            raise Exception('Rotation index does not match rotation map')
+        return True
+
     @staticmethod
     def _standard_t(t):
         if t < 0:
@@ -238,12 +446,124 @@ class CameraRotate:
         return t
 
 
+class CameraGrid:
+    """
+    Conversion between the hex pixel layout and a dense 2-D grid in
+    axial coordinates, for convolutional models.
+
+    Pixel (q, r) sits in grid row r and column q, so the six neighbours
+    of a pixel are its grid neighbours except the two on one diagonal.
+    Grid cells without a pixel, in the corners and where the outer two
+    spirals are incomplete, are masked out.
+    """
+
+    # (rows, cols) scatter index and (H, W) mask, computed once and
+    # shared by every CameraGrid
+    _index = None
+    _mask = None
+
+    def __init__(self, fill=0.):
+        self.fill = fill
+
+    @classmethod
+    def _build(cls):
+        if cls._index is None:
+            xy = Camera.unit_xy()
+            i = np.rint(xy[0] / (math.sqrt(3)/2.)).astype('int64')
+            r = np.rint(xy[1] / (3./2.)).astype('int64')
+            q = (i - r) // 2
+
+            rows = r - r.min()
+            cols = q - q.min()
+            mask = np.zeros((rows.max()+1, cols.max()+1), dtype=bool)
+            mask[rows, cols] = True
+
+            rows.setflags(write=False)
+            cols.setflags(write=False)
+            mask.setflags(write=False)
+            cls._index = (rows, cols)
+            cls._mask = mask
+
+    @property
+    def index(self):
+        """
+        Grid row and column of each pixel
+        """
+        self._build()
+        return self._index
+
+    @property
+    def mask(self):
+        """
+        (H, W) array, True where a grid cell holds a pixel
+        """
+        self._build()
+        return self._mask
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    def to_grid(self, charges):
+        """
+        charges: (..., 499) array of pixel charges
+
+        Returns (..., H, W) grids with empty cells set to fill
+        """
+        charges = np.asarray(charges)
+        rows, cols = self.index
+        grid = np.full(charges.shape[:-1] + self.shape, self.fill,
+                       dtype=charges.dtype)
+        grid[..., rows, cols] = charges
+        return grid
+
+    def from_grid(self, grid):
+        """
+        grid: (..., H, W) array
+
+        Returns (..., 499) pixel charges
+        """
+        rows, cols = self.index
+        return np.asarray(grid)[..., rows, cols]
+
+
 class CameraPlot:
+    """
+    Draws camera charges as hexagonal pixels.
+
+    Hexagon vertices for the whole camera are computed once per pixel
+    size, so drawing a subject only creates one PolyCollection from the
+    shared vertex array and sets its colours.
+    """
 
     camera = Camera()
 
+    # Vertex arrays by pixel side length
+    _vertices = {}
+
+    @classmethod
+    def vertices(cls, radius=1.):
+        """
+        (499, 6, 2) array of hexagon vertices for every pixel
+        """
+        if radius not in cls._vertices:
+            xy = Camera.unit_xy().T * radius
+            t = 2*math.pi*np.arange(1, 7)/6 + math.pi/2
+            hexagon = np.stack([np.cos(t), np.sin(t)], axis=1) * radius
+            vertices = xy[:, np.newaxis, :] + hexagon[np.newaxis]
+            vertices.setflags(write=False)
+            cls._vertices[radius] = vertices
+        return cls._vertices[radius]
+
     @classmethod
     def plot(cls, data, ax, **kwargs):
+        """
+        data: (499,) charges, or the (499, 3) x, y, c array
+              from Camera.transform
+
+        Returns the PolyCollection, whose colours can be changed with
+        update to draw another subject on the same axes
+        """
         radius = kwargs.get('radius', 1.)
         bounds = (-21*radius, 21*radius)
         ax.set_xlim(*bounds)
@@ -251,20 +571,23 @@ class CameraPlot:
         for loc, spine in ax.spines.items():
             spine.set_color('none')
 
+        c = np.asarray(data)
+        if c.ndim == 2:
+            c = c[:, 2]
 
-        colors = []
-        patches = []
-        rot = math.pi/2
-        for i, item in enumerate(data):
-            x, y, c = item
-            patches.append(cls.get_patch(x, y, rotation=rot, **kwargs))
-            colors.append(c)
-            rot += math.pi/3
-
-        pc = PatchCollection(patches, cmap=muon.config.cmap, alpha=1)
-        pc.set_array(np.array(colors))
+        pc = PolyCollection(cls.vertices(radius)[:len(c)],
+                            cmap=muon.config.cmap, alpha=1)
+        pc.set_array(c)
         ax.add_collection(pc)
+        return pc
 
+    @staticmethod
+    def update(pc, charge):
+        """
+        Colour an existing PolyCollection with new charges
+        """
+        pc.set_array(np.asarray(charge))
+        pc.autoscale()
 
     @classmethod
     def get_patch(cls, x, y,
@@ -272,25 +595,9 @@ class CameraPlot:
                   radius=1.,
                   **kwargs):
 
-        cos = math.cos
-        sin = math.sin
-        pi = math.pi
-        n_sides = 6
-
-        def _x(i):
-            i = float(i)
-            return x + radius * cos(2*pi*i/n_sides + rotation) 
+        t = 2*math.pi*np.arange(1, 7)/6 + rotation
+        vertices = np.stack([x + radius*np.cos(t), y + radius*np.sin(t)],
+                            axis=1)
 
-        def _y(i):
-            i = float(i)
-            return y + radius * sin(2*pi*i/n_sides + rotation)
-
-        vertices = []
-        for i in range(n_sides):
-            i += 1
-            vertices.append((_x(i), _y(i)))
-        vertices = np.array(vertices)
-
-        polygon = Polygon(vertices, True)
+        polygon = Polygon(vertices, closed=True)
         return polygon
-
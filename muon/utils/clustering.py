@@ -56,11 +56,10 @@ class Cluster:
                             wspace=.05)
 
         count = self.pca.n_components_
+        x, y, c = camera.transform(self.pca.components_[:count])
         for n in range(count):
-            component = self.pca.components_[n, :]
-            x, y, c = camera.transform(component)
             ax = fig.add_subplot(1, count+1, n+1, xticks=[], yticks=[])
-            ax.scatter(x, y, c=c, s=10, cmap='viridis')
+            ax.scatter(x[n], y[n], c=c[n], s=10, cmap='viridis')
 
         x, y, c = camera.transform(self.mean_charge())
         ax = fig.add_subplot(1, 1, 1, xticks=[], yticks=[])
@@ -69,11 +68,7 @@ class Cluster:
         plt.show()
 
     def mean_charge(self):
-        subjects = self.subjects.list()
-        c = [s.charge for s in subjects]
-        c = np.array(c)
-        c = np.mean(c, axis=0)
-        return c
+        return np.mean(self.subjects.charge, axis=0)
 
     def visualize_mean(self):
         camera = Camera()
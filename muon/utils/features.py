@@ -0,0 +1,317 @@
+
+from collections import OrderedDict
+import math
+import numpy as np
+
+from muon.utils.camera import Camera
+
+
+class Islands:
+    """
+    Connected islands of hit pixels, labelled for a batch of
+    subjects at once.
+
+    Each hit pixel starts with its own number as label and repeatedly
+    takes the largest label among itself and its hit neighbours, until
+    every pixel holds the largest pixel number in its island.
+    """
+
+    chunk = 4096
+
+    def __init__(self, threshold=0.):
+        """
+        threshold: pixels with charge above threshold are hit
+        """
+        self.threshold = threshold
+        self.neighbours = Camera().neighbours
+
+    def label(self, charges):
+        """
+        charges: (N, 499) array
+
+        Returns (N, 499) island labels numbered from 1 in each subject,
+        0 for pixels that are not hit
+        """
+        charges = np.asarray(charges)
+        labels = np.zeros(charges.shape, dtype='int64')
+        for a in range(0, len(charges), self.chunk):
+            b = min(len(charges), a + self.chunk)
+            labels[a:b] = self._label(charges[a:b])
+        return labels
+
+    def _label(self, charges):
+        n, width = charges.shape
+        hit = charges > self.threshold
+
+        # Column 0 of the padded labels stands in for missing neighbours
+        table = self.neighbours + 1
+        padded = np.zeros((n, width+1), dtype='int64')
+        padded[:, 1:] = np.where(hit, np.arange(1, width+1), 0)
+
+        # Only subjects whose labels still change are updated
+        active = np.arange(n)
+        while len(active):
+            p = padded[active]
+            new = p[:, table].max(axis=2)
+            new = np.maximum(p[:, 1:], new)
+            # Labels are pixel numbers, so also take the label of the
+            # pixel a label names, which cuts the steps needed
+            p[:, 1:] = new
+            new = np.take_along_axis(p, new, axis=1)
+            new[~hit[active]] = 0
+
+            changed = (new != padded[active, 1:]).any(axis=1)
+            padded[active, 1:] = new
+            active = active[changed]
+        labels = padded[:, 1:]
+
+        # The pixel whose own number is its label is the island's root,
+        # and islands are numbered by the order of their roots
+        roots = hit & (labels == np.arange(1, width+1))
+        rank = np.zeros((n, width+1), dtype='int64')
+        rank[:, 1:] = np.where(roots, np.cumsum(roots, axis=1), 0)
+        return np.take_along_axis(rank, labels, axis=1)
+
+    def sizes(self, labels):
+        """
+        labels: (N, 499) island labels from label
+
+        Returns (N, K) pixel count of each island, largest first and
+        padded with zeros, where K is the most islands in any subject
+        """
+        n = len(labels)
+        k = labels.max() if labels.size else 0
+        flat = (np.arange(n)[:, np.newaxis] * (k+1) + labels).ravel()
+        sizes = np.bincount(flat, minlength=n*(k+1)).reshape(n, k+1)
+        return -np.sort(-sizes[:, 1:], axis=1)
+
+    def __call__(self, charges):
+        """
+        Returns the number of islands, the (N, K) island sizes and the
+        (N, 499) island labels of each subject
+        """
+        labels = self.label(charges)
+        sizes = self.sizes(labels)
+        return (sizes > 0).sum(axis=1), sizes, labels
+
+
+class Hillas:
+    """
+    Hillas image parameters for a batch of subjects, in units of the
+    pixel side length.
+
+    All charge weighted moments come from one product of the charge
+    matrix with a (499, 6) table of pixel monomials, so each chunk is
+    read once.
+    """
+
+    columns = ['hillas_size', 'hillas_x', 'hillas_y', 'hillas_width',
+               'hillas_length', 'hillas_psi', 'hillas_concentration']
+    chunk = 65536
+
+    def __init__(self, threshold=0.):
+        """
+        threshold: only pixels with charge above threshold are used
+        """
+        self.threshold = threshold
+
+        x, y = Camera.unit_xy()
+        self.monomials = np.stack(
+            [np.ones_like(x), x, y, x**2, y**2, x*y], axis=1)
+
+    def options(self):
+        """
+        Options that change the parameters, stored with the features
+        """
+        return {'threshold': float(self.threshold)}
+
+    def params(self, charges):
+        """
+        charges: (N, 499) array
+
+        Returns a dict of (N,) arrays for each of columns. size is the
+        total charge, x and y the centroid, width and length the rms
+        spread along the minor and major axes, psi the angle of the
+        major axis and concentration the fraction of the charge in the
+        two brightest pixels. All but size are nan for empty images.
+        """
+        charges = np.asarray(charges)
+        out = OrderedDict(
+            (c, np.full(len(charges), np.nan)) for c in self.columns)
+
+        for a in range(0, len(charges), self.chunk):
+            b = min(len(charges), a + self.chunk)
+            q = np.asarray(charges[a:b], dtype='float64')
+            q = np.where(q > self.threshold, q, 0)
+
+            m = np.dot(q, self.monomials)
+            size = m[:, 0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                x, y, xx, yy, xy = (m[:, 1:].T / size)
+
+                sxx = xx - x**2
+                syy = yy - y**2
+                sxy = xy - x*y
+
+                # Eigenvalues of the covariance matrix
+                mean = (sxx + syy) / 2
+                diff = np.hypot((sxx - syy) / 2, sxy)
+                length = np.sqrt(np.maximum(mean + diff, 0))
+                width = np.sqrt(np.maximum(mean - diff, 0))
+                psi = np.arctan2(2*sxy, sxx - syy) / 2
+
+                top = np.partition(q, q.shape[1]-2, axis=1)[:, -2:]
+                concentration = top.sum(axis=1) / size
+
+            for c, v in zip(self.columns, [size, x, y, width, length,
+                                           psi, concentration]):
+                out[c][a:b] = v
+
+        return out
+
+
+class RingFit:
+    """
+    Charge weighted circle fits for a batch of subjects, in units of
+    the pixel side length.
+
+    The algebraic (Kasa) fit minimises sum w (x^2 + y^2 + D x + E y + F)^2,
+    which is linear in D, E and F, so the 3x3 normal equations of every
+    subject are built with one matrix product and solved together.
+    Optional Gauss-Newton steps then minimise the geometric distance
+    sum w (|p - c| - r)^2, which removes the algebraic fit's bias
+    towards small radii on partial rings.
+    """
+
+    columns = ['ring_radius', 'ring_x', 'ring_y',
+               'ring_residual', 'ring_completeness']
+    chunk = 16384
+
+    def __init__(self, threshold=0., refine=0, bins=36, band=None):
+        """
+        threshold: pixels with charge above threshold are fit, weighted
+                   by their charge above threshold
+        refine: number of Gauss-Newton steps after the algebraic fit
+        bins: azimuthal bins around the centre for ring completeness
+        band: distance from the ring for a pixel to count towards
+              completeness, one pixel spacing by default
+        """
+        self.threshold = threshold
+        self.refine = refine
+        self.bins = bins
+        self.band = band or math.sqrt(3)
+
+        xy = Camera.unit_xy()
+        self.x = xy[0]
+        self.y = xy[1]
+
+    def options(self):
+        """
+        Options that change the fit, stored with the features
+        """
+        return {'threshold': float(self.threshold), 'refine': self.refine,
+                'bins': self.bins, 'band': float(self.band)}
+
+    def fit(self, charges):
+        """
+        charges: (N, 499) array
+
+        Returns a dict of (N,) arrays for each of columns,
+        nan where a subject has fewer than three hit pixels
+        """
+        charges = np.asarray(charges)
+        out = OrderedDict(
+            (c, np.full(len(charges), np.nan)) for c in self.columns)
+
+        for a in range(0, len(charges), self.chunk):
+            b = min(len(charges), a + self.chunk)
+            w = np.asarray(charges[a:b], dtype='float64') - self.threshold
+            w = np.maximum(w, 0)
+
+            valid = (w > 0).sum(axis=1) >= 3
+            w = w[valid]
+            cx, cy, r = self._kasa(w)
+            for _ in range(self.refine):
+                cx, cy, r = self._step(w, cx, cy, r)
+            residual, completeness = self._quality(w, cx, cy, r)
+
+            for c, v in zip(self.columns,
+                            [r, cx, cy, residual, completeness]):
+                out[c][a:b][valid] = v
+
+        return out
+
+    @staticmethod
+    def _solve(m, v):
+        """
+        Solve a batch of 3x3 systems, falling back to the pseudo
+        inverse when any of them is singular
+        """
+        try:
+            return np.linalg.solve(m, v[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            return np.einsum('nij,nj->ni', np.linalg.pinv(m), v)
+
+    def _kasa(self, w):
+        x, y = self.x, self.y
+        f = np.stack([x, y, np.ones_like(x)], axis=1)
+        products = (f[:, :, np.newaxis] * f[:, np.newaxis, :])
+        m = np.dot(w, products.reshape(len(x), 9)).reshape(-1, 3, 3)
+        v = np.dot(w, f * -(x**2 + y**2)[:, np.newaxis])
+
+        d, e, f = self._solve(m, v).T
+        cx = -d / 2
+        cy = -e / 2
+        with np.errstate(invalid='ignore'):
+            r = np.sqrt(cx**2 + cy**2 - f)
+        return cx, cy, r
+
+    def _step(self, w, cx, cy, r):
+        dx = self.x - cx[:, np.newaxis]
+        dy = self.y - cy[:, np.newaxis]
+        d = np.maximum(np.hypot(dx, dy), 1e-9)
+
+        # The Jacobian of the residuals d - r with respect to cx, cy
+        # and r is (-u, -v, -1) with (u, v) the unit vector from the
+        # centre, so the normal equations are weighted sums of products
+        u = dx / d
+        v = dy / d
+        e = d - r[:, np.newaxis]
+        wu = w * u
+        wv = w * v
+
+        m = np.empty((len(w), 3, 3))
+        m[:, 0, 0] = (wu * u).sum(axis=1)
+        m[:, 0, 1] = m[:, 1, 0] = (wu * v).sum(axis=1)
+        m[:, 0, 2] = m[:, 2, 0] = wu.sum(axis=1)
+        m[:, 1, 1] = (wv * v).sum(axis=1)
+        m[:, 1, 2] = m[:, 2, 1] = wv.sum(axis=1)
+        m[:, 2, 2] = w.sum(axis=1)
+        g = np.stack([(wu * e).sum(axis=1), (wv * e).sum(axis=1),
+                      (w * e).sum(axis=1)], axis=1)
+
+        step = self._solve(m, g)
+        return cx + step[:, 0], cy + step[:, 1], r + step[:, 2]
+
+    def _quality(self, w, cx, cy, r):
+        """
+        Weighted rms distance of the charge from the ring, and the
+        fraction of azimuthal bins holding charge near the ring
+        """
+        dx = self.x - cx[:, np.newaxis]
+        dy = self.y - cy[:, np.newaxis]
+        e = np.hypot(dx, dy) - r[:, np.newaxis]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            residual = np.sqrt((w * e**2).sum(axis=1) / w.sum(axis=1))
+
+        # Angles are only needed for the few pixels near each ring
+        n, p = np.nonzero((w > 0) & (np.abs(e) < self.band))
+        t = np.arctan2(dy[n, p], dx[n, p])
+        bins = ((t + math.pi) / (2*math.pi) * self.bins).astype('int64')
+        bins = np.minimum(bins, self.bins - 1)
+
+        occupied = np.bincount(n * self.bins + bins,
+                               minlength=len(w)*self.bins)
+        occupied = occupied.reshape(len(w), self.bins) > 0
+        completeness = occupied.sum(axis=1) / self.bins
+        return residual, completeness
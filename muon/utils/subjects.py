@@ -1,9 +1,13 @@
 
 from muon.utils.camera import Camera, CameraPlot, CameraRotate
+from muon.utils.features import Hillas, RingFit
 
 from collections import OrderedDict
 import os
+import pickle
 import re
+import json
+import multiprocessing
 import numpy as np
 import h5py
 import random
@@ -19,10 +23,9 @@ class Subject:
         self.id = subject
         self.event = event
         self.charge = np.array(charge)
-        self.scaled_charge = None
         self.label = label
 
-        self._normalize()
+        self._scaled_charge = None
 
     def plot(self, ax, camera=None):
         if camera is None:
@@ -31,8 +34,7 @@ class Subject:
         # x, y, c = camera.transform(self.charge)
         # ax.scatter(x, y, c=c, s=10, cmap='viridis')
 
-        data = camera.transform(self.charge, False)
-        CameraPlot.plot(data, ax, radius=camera.pixSideLength)
+        CameraPlot.plot(self.charge, ax, radius=camera.pixSideLength)
         return ax
 
     @staticmethod
@@ -40,35 +42,482 @@ class Subject:
 
         return (.9, .1, .1)
 
-    def _normalize(self):
-        n = np.linalg.norm(self.charge)
-        d = self.charge.shape[0]
+    @property
+    def scaled_charge(self):
+        if self._scaled_charge is None:
+            self._scaled_charge = self.scale(self.charge)
+        return self._scaled_charge
+
+    @scaled_charge.setter
+    def scaled_charge(self, scaled_charge):
+        self._scaled_charge = scaled_charge
+
+    @staticmethod
+    def scale(charge):
+        n = np.linalg.norm(charge)
+        d = charge.shape[0]
         if n == 0:
-            self.scaled_charge = self.charge.copy()
-        else:
-            c = self.charge / n * math.sqrt(d)
-            self.scaled_charge = c
+            return np.array(charge)
+        return charge / n * math.sqrt(d)
 
     def __str__(self):
         return 'id %d event %s' % \
                (self.id, self.event)
 
+
+class SubjectView(Subject):
+    """
+    Subject backed by a row of a SubjectArrays storage. Charges are read
+    from the storage arrays, and labels are written back to it.
+    """
+
+    def __init__(self, arrays, row):
+        self._arrays = arrays
+        self._row = row
+        self.id = int(arrays.ids[row])
+
+        event = tuple(int(i) for i in arrays.events[row])
+        if event == (-1, -1, -1):
+            event = None
+        self.event = event
+
+    @property
+    def charge(self):
+        return self._arrays.charge[self._row]
+
+    @property
+    def scaled_charge(self):
+        return self._arrays.scaled_charge[self._row]
+
+    @property
+    def label(self):
+        return int(self._arrays.labels[self._row])
+
+    @label.setter
+    def label(self, label):
+        self._arrays.set_labels(self._row, label)
+
+
+class SubjectArrays:
+    """
+    Aligned subject arrays shared by a Subjects container and every
+    subset view taken from it.
+
+    ids: (N,) subject ids
+    charge: (N, width) raw charges
+    events: (N, 3) run, evt, tel of each subject, -1 if unknown
+    labels: (N,) subject labels, -1 if unlabeled
+    scaled_charge: (N, width) scaled charges, computed on first use
+                   if not given
+    features: dict of name to (N,) feature column, nan where a
+              feature was not computed
+    feature_options: dict of feature set, like 'hillas', to the
+                     options its columns were computed with
+
+    The scaled charges are computed in one vectorized pass and stored
+    once. keep_scaled_only drops the raw charges to save memory.
+    """
+
+    # dtype of the scaled charge matrix
+    dtype = 'float64'
+    chunk = 65536
+
+    def __init__(self, ids, charge, events=None, labels=None,
+                 scaled_charge=None):
+        ids = np.asarray(ids, dtype='int64')
+        if events is None:
+            events = np.full((len(ids), 3), -1)
+        if labels is None:
+            labels = np.full(len(ids), -1)
+
+        self.ids = ids
+        self.events = np.asarray(events, dtype='int64').reshape(-1, 3)
+        self.labels = np.array(labels, dtype='int64')
+        self._charge = charge
+
+        # Incremented whenever labels change, to invalidate arrays
+        # derived from them
+        self.version = 0
+
+        self._scaled_charge = scaled_charge
+        self._index = None
+
+        self.features = OrderedDict()
+        self.feature_options = {}
+
+    def set_labels(self, rows, labels):
+        self.labels[rows] = labels
+        self.version += 1
+
+    def set_features(self, rows, columns):
+        """
+        columns: dict of feature name to values for the given rows
+        """
+        for name, values in columns.items():
+            if name not in self.features:
+                self.features[name] = np.full(len(self), np.nan)
+            self.features[name][rows] = values
+
+    @property
+    def charge(self):
+        """
+        Raw charges, or the scaled charges if the raw charges
+        were dropped
+        """
+        if self._charge is None:
+            return self.scaled_charge
+        return self._charge
+
+    @property
+    def scaled_charge(self):
+        if self._scaled_charge is None:
+            self._scaled_charge = self.scale(self._charge, self.dtype)
+        return self._scaled_charge
+
+    def keep_scaled_only(self, dtype='float32'):
+        """
+        Keep only the scaled charges, stored as dtype
+        """
+        if self._charge is None:
+            return
+        if self._scaled_charge is None or \
+                self._scaled_charge.dtype != np.dtype(dtype):
+            self._scaled_charge = self.scale(self._charge, dtype)
+        self._charge = None
+
+    @classmethod
+    def scale(cls, charge, dtype='float64', out=None):
+        """
+        Scale each row of the charge matrix to a norm of sqrt(width),
+        in chunks to bound temporary memory
+
+        out: optional (N, width) array to write the result to
+        """
+        if len(charge) == 0:
+            return np.array(charge, dtype=dtype)
+        if out is None:
+            out = np.empty(charge.shape, dtype=dtype)
+
+        d = charge.shape[1]
+        for a in range(0, len(charge), cls.chunk):
+            b = min(len(charge), a + cls.chunk)
+            c = np.asarray(charge[a:b], dtype=dtype)
+            n = np.linalg.norm(c, axis=1)
+            n[n == 0] = math.sqrt(d)
+            out[a:b] = c * (math.sqrt(d) / n)[:, np.newaxis]
+        return out
+
+    @property
+    def index(self):
+        """
+        Map of subject id to row
+        """
+        if self._index is None:
+            self._index = {s: i for i, s in enumerate(self.ids.tolist())}
+        return self._index
+
+    def take(self, rows):
+        """
+        Copy of the given rows as new storage
+        """
+        charge = None
+        scaled_charge = None
+        if self._charge is not None:
+            charge = np.array(self._charge[rows])
+        if self._scaled_charge is not None:
+            scaled_charge = np.array(self._scaled_charge[rows])
+
+        arrays = self.__class__(
+            self.ids[rows], charge, self.events[rows], self.labels[rows],
+            scaled_charge)
+        for name, column in self.features.items():
+            arrays.features[name] = column[rows]
+        return arrays
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        # Derived arrays are rebuilt after loading
+        state = self.__dict__.copy()
+        if self._charge is not None:
+            state['_scaled_charge'] = None
+        state['_index'] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('features', OrderedDict())
+        state.setdefault('feature_options', {})
+        self.__dict__.update(state)
+
+
 class Subjects:
+    """
+    Collection of subjects stored as aligned numpy arrays.
+
+    ids, events (run, evt, tel), labels, and the raw and scaled charges
+    share the same row order, and an index maps subject id to row.
+    Subject objects are only created as views when a single subject is
+    accessed.
+
+    Subsets are views: they share the SubjectArrays of the container
+    they were taken from and only hold an array of its rows. Labels
+    set through any view are seen by all of them. Use materialize to
+    copy a view into its own storage.
+    """
 
     _mapping = None
+    _view_class = None
+
+    # Memory budget in bytes for the derived arrays each
+    # Subjects container keeps cached
+    cache_size = 2**30
 
     def __init__(self, subjects):
-        if type(subjects) is list:
-            subjects = [(s.id, s) for s in subjects]
-        self.subjects = OrderedDict(subjects)
+        if isinstance(subjects, dict):
+            subjects = list(subjects.values())
+        subjects = list(subjects)
+
+        ids = [s.id for s in subjects]
+        events = [s.event or (-1, -1, -1) for s in subjects]
+        labels = [s.label for s in subjects]
+        charge = np.array([s.charge for s in subjects])
+
+        self._init_arrays(SubjectArrays(ids, charge, events, labels))
+
+    def _init_arrays(self, arrays, rows=None):
+        self._arrays = arrays
+        self._rows = rows
+        self._index = None
 
-        self.dimensions = self._dimensions(self.list())
+        self._cache = ArrayCache(self.cache_size)
+        self._cache_version = arrays.version
+
+    @classmethod
+    def from_arrays(cls, ids, charge, events=None, labels=None):
+        """
+        Create subjects directly from aligned arrays
+
+        ids: (N,) subject ids
+        charge: (N, width) raw charges
+        events: (N, 3) run, evt, tel of each subject
+        labels: (N,) subject labels, -1 if unlabeled
+        """
+        subjects = cls.__new__(cls)
+        subjects._init_arrays(SubjectArrays(ids, charge, events, labels))
+        return subjects
+
+    ##########################################################################
+    ###   Arrays   ###########################################################
+    ##########################################################################
+
+    def _select(self, array):
+        if self._rows is None:
+            return array
+        return array[self._rows]
+
+    @property
+    def ids(self):
+        return self._select(self._arrays.ids)
+
+    @property
+    def events(self):
+        return self._select(self._arrays.events)
+
+    @property
+    def labels(self):
+        labels = self._select(self._arrays.labels).view()
+        labels.flags.writeable = False
+        return labels
+
+    def set_labels(self, labels):
+        """
+        labels: dict of subject id to label
+        """
+        subjects = list(labels)
+        rows = self.rows(subjects)
+        if self._rows is not None:
+            rows = self._rows[rows]
+        self._arrays.set_labels(rows, [labels[s] for s in subjects])
+
+    def features(self, names=None):
+        """
+        Feature columns of these subjects
+
+        names: feature names to return, all by default
+        """
+        if names is None:
+            names = list(self._arrays.features)
+        return OrderedDict(
+            (n, self._select(self._arrays.features[n])) for n in names)
+
+    def set_features(self, columns):
+        """
+        Store feature columns alongside the subjects. Features set
+        through a view are seen by every view of the same storage, nan
+        for subjects outside the view.
+
+        columns: dict of feature name to (N,) values in subject order
+        """
+        rows = self._rows
+        if rows is None:
+            rows = np.arange(len(self))
+        self._arrays.set_features(rows, columns)
+
+    def feature_table(self, names=None):
+        """
+        (N, k) array of feature columns, for use as model input
+
+        names: feature names to include, all by default
+        """
+        features = self.features(names)
+        if not features:
+            return np.zeros((len(self), 0))
+        return np.stack(list(features.values()), axis=1)
+
+    def save_features(self, fname, names=None):
+        """
+        Save feature columns to an npz file keyed by subject id, with
+        the options they were computed with. Subjects in an existing
+        file that are not in this container are kept.
+        """
+        ids = self.ids
+        features = self.features(names)
+        options = {}
+        if os.path.isfile(fname):
+            options = self.feature_file_options(fname)
+            with np.load(fname) as data:
+                old = np.array([i not in self.index for i in data['ids']],
+                               dtype=bool)
+                if old.any():
+                    ids = np.concatenate([data['ids'][old], ids])
+                    for name in features:
+                        if name in data:
+                            column = data[name][old]
+                        else:
+                            column = np.full(old.sum(), np.nan)
+                        features[name] = np.concatenate(
+                            [column, features[name]])
+
+        options.update(self._arrays.feature_options)
+        with open(fname, 'wb') as file:
+            np.savez(file, ids=ids, options=json.dumps(options), **features)
+
+    @staticmethod
+    def feature_file_options(fname):
+        """
+        Options of the feature sets in a save_features file, empty for
+        files saved without them
+        """
+        with np.load(fname) as data:
+            if 'options' not in data.files:
+                return {}
+            return json.loads(str(data['options']))
+
+    def load_features(self, fname):
+        """
+        Load feature columns saved with save_features for the subjects
+        in this container
+        """
+        with np.load(fname) as data:
+            ids = data['ids']
+            found = np.array([i in self.index for i in ids], dtype=bool)
+            rows = self.rows(ids[found])
+
+            columns = OrderedDict()
+            for name in data.files:
+                if name not in ['ids', 'options']:
+                    column = np.full(len(self), np.nan)
+                    column[rows] = data[name][found]
+                    columns[name] = column
+        self.set_features(columns)
+        self._arrays.feature_options.update(self.feature_file_options(fname))
+
+    @property
+    def charge(self):
+        return self._select(self._arrays.charge)
+
+    @property
+    def scaled_charge(self):
+        return self._select(self._arrays.scaled_charge)
+
+    @property
+    def index(self):
+        """
+        Map of subject id to row
+        """
+        if self._rows is None:
+            return self._arrays.index
+        if self._index is None:
+            self._index = {s: i for i, s in enumerate(self.ids.tolist())}
+        return self._index
+
+    def rows(self, subjects):
+        """
+        Rows of the given subject ids
+        """
+        index = self.index
+        return np.array([index[int(s)] for s in subjects], dtype='int64')
+
+    def charge_rows(self, rows):
+        """
+        Raw charges of the given rows, without copying any other rows
+        """
+        rows = np.asarray(rows, dtype='int64')
+        if self._rows is not None:
+            rows = self._rows[rows]
+        return self._arrays.charge[rows]
+
+    def _storage_row(self, row):
+        if self._rows is None:
+            return row
+        return int(self._rows[row])
+
+    def _take(self, rows):
+        """
+        View of the given rows sharing this container's storage
+        """
+        rows = np.asarray(rows, dtype='int64')
+        if self._rows is not None:
+            rows = self._rows[rows]
+
+        view = self._new()
+        view._init_arrays(self._arrays, rows)
+        return view
+
+    def _new(self):
+        cls = self._view_class or self.__class__
+        return cls.__new__(cls)
+
+    def is_view(self):
+        return self._rows is not None
+
+    def materialize(self):
+        """
+        Copy of these subjects in their own storage
+        """
+        subjects = self._new()
+        rows = self._rows
+        if rows is None:
+            rows = np.arange(len(self))
+        subjects._init_arrays(self._arrays.take(rows))
+        return subjects
+
+    @property
+    def dimensions(self):
+        l = len(self)
+        if l > 0:
+            return l, self._arrays.charge.shape[1]
+        return l,
 
     @classmethod
     def from_data(cls, data_file):
         if not os.path.isfile(data_file):
             raise IOError('Data file doesn\'t exist!')
 
+        if Columnar_Data.is_columnar(data_file):
+            return cls._from_columnar(data_file)
+
         subject_data = Subject_Data(data_file)
         subjects = {}
         for subject, evt, charge in subject_data:
@@ -81,66 +530,60 @@ class Subjects:
 
         return cls(subjects)
 
+    @classmethod
+    def _from_columnar(cls, data_file):
+        """
+        Load subjects from a columnar data file with a few bulk reads
+        """
+        columnar = Columnar_Data(data_file)
+        data = columnar.read()
+        columnar.close()
+
+        events = np.stack([data['run'], data['evt'], data['tel']], 1)
+        return cls.from_arrays(
+            data['subject'], data['charge'][:, :-1], events)
+
     def sample(self, size):
         size = int(size)
-        subjects = list(self.subjects.values())
-        print('number of subjects', len(subjects))
-        if size > len(subjects):
-            return subjects
-        return random.sample(subjects, size)
+        print('number of subjects', len(self))
+        if size > len(self):
+            return self.list()
+        rows = random.sample(range(len(self)), size)
+        return [SubjectView(self._arrays, self._storage_row(i))
+                for i in rows]
 
     ##########################################################################
     ###   Subsets   ##########################################################
     ##########################################################################
 
     def _sample_s(self, size):
-        return self.__class__(self.sample(size))
+        size = int(size)
+        if size > len(self):
+            return self._take(np.arange(len(self)))
+        return self._take(random.sample(range(len(self)), size))
 
     def iter(self):
-        for s in self.subjects.values():
-            yield s
+        for i in range(len(self)):
+            yield SubjectView(self._arrays, self._storage_row(i))
 
     def list(self):
-        return list(self.subjects.values())
+        return list(self.iter())
 
     def keys(self):
-        return list(self.subjects.keys())
+        return self.ids.tolist()
 
     def subset(self, subjects):
-        subset = [self.subjects[s] for s in subjects]
-        return self.__class__(subset)
-
-    # def labels(self, order):
-        # labels = np.zeros(len(order))
-        # for i, s in enumerate(order):
-            # l = self.subjects[s].label
-            # if l == -1:
-                # l = None
-            # labels[i] = l
-
-        # return labels
+        return self._take(self.rows(subjects))
 
     def labeled_subjects(self):
-        subjects = []
-        for s in self.list():
-            if s.label in [0, 1]:
-                subjects.append(s)
-
-        return self.__class__(subjects)
+        rows = np.where(np.isin(self.labels, [0, 1]))[0]
+        return self._take(rows)
 
     def sorted_subjects(self, method='swap'):
         if method == 'swap':
             s = sorted(self.list(), key=lambda s: s.score)
         return self.__class__(s)
 
-    @staticmethod
-    def _dimensions(subjects):
-        l = len(subjects)
-        if l > 0:
-            w = len(subjects[0].charge)
-            return l, w
-        return l,
-
     @classmethod
     def evt_to_subj(cls, evt, mapping):
         """
@@ -155,6 +598,7 @@ class Subjects:
         evt = (*evt[:2], -1)
         return mapping.get(evt, None)
 
+
     ##########################################################################
     ###   Plotting   #########################################################
     ##########################################################################
@@ -171,12 +615,12 @@ class Subjects:
         if fig is None:
             fig = plt.figure()
 
-        l = math.ceil(len(self.subjects) / w)
+        l = math.ceil(len(self) / w)
         fig.set_size_inches(2*w, 2*l)
         fig.subplots_adjust(left=0, right=1, bottom=0, top=1, hspace=.05,
                             wspace=.05)
 
-        axes = fig.subplots(l, w, True, subplot_kw={
+        axes = fig.subplots(l, w, sharex=True, subplot_kw={
             'xticks': [],
             'yticks': []
         })
@@ -261,118 +705,406 @@ class Subjects:
     ##########################################################################
 
     def get_xy_volunteer(self, labels, rotation):
-        x = []
-        y = []
-        cr = CameraRotate()
-        for s in self.iter():
-            for l in labels[s.id]:
-                if rotation:
-                    n = 6
-                else:
-                    n = 1
-                for n in range(n):
-                    x.append(cr.rotate(s.scaled_charge, n))
-                    y.append(l)
-        x = np.array(x)
+        """
+        labels: dict of subject id to list of volunteer labels
+        """
+        counts = [len(labels[s]) for s in self.keys()]
+        rows = np.repeat(np.arange(len(self)), counts)
+        y = [l for s in self.keys() for l in labels[s]]
         y = np.array(y)
+
+        x = self.scaled_charge[rows]
+        if rotation:
+            x = self._rotate_all(x, rotation)
+            y = np.repeat(y, self.symmetries(rotation))
         return x, y
 
     def get_xy(self, labels, rotation):
-        x = []
-        y = []
-        cr = CameraRotate()
-        for s in self.iter():
-            label = labels[s.id]
-            if rotation:
-                for n in range(6):
-                    x.append(cr.rotate(s.scaled_charge, n))
-                    y.append(label)
-            else:
-                x.append(s.scaled_charge)
-                y.append(label)
-
-        x = np.array(x)
-        y = np.array(y)
+        """
+        labels: dict of subject id to label
+        """
+        y = np.array([labels[s] for s in self.keys()])
+        x = self.get_x(rotation)
+        if rotation:
+            y = np.repeat(y, self.symmetries(rotation))
         return x, y
 
     def get_x(self, rotation):
-        x = []
-        cr = CameraRotate()
-        for s in self.iter():
-            if rotation:
-                n = 6
-            else:
-                n = 1
-            for n in range(n):
-                x.append(cr.rotate(s.scaled_charge, n))
-        return np.array(x)
+        return self._cached('x', rotation)
 
     def get_charge_array(self, order=True, rotation=False, labels=False):
+        """
+        rotation: True to include the six rotations of each subject,
+                  'reflect' to also include the six reflections
+        """
         if rotation:
-            return self._rotated_charge_array(order, labels)
-        subjects = self.list()
-
-        dimensions = self.dimensions
-        charges = np.zeros(dimensions)
-        _order = np.zeros(dimensions[0])
-        _labels = np.zeros(dimensions[0])
-
-        for i, subject in enumerate(subjects):
-            _order[i] = subject.id
-            _labels[i] = subject.label
-            charges[i] = subject.scaled_charge
+            return self._rotated_charge_array(order, labels, rotation)
 
-        out = [charges]
+        out = [self._cached('x', False)]
         if order:
-            out = [_order] + out
+            out = [self._cached('ids', False)] + out
         if labels:
-            out += [_labels]
+            out += [self._cached('labels', False)]
         return tuple(out)
 
-    def _rotated_charge_array(self, order=True, labels=False):
-        dimensions = self.dimensions
-        dimensions = (dimensions[0]*6, dimensions[1])
-
-        cr = CameraRotate()
-        charges = np.zeros(dimensions)
-        _order = np.zeros(dimensions[0])
-        _labels = np.zeros(dimensions[0])
-        rotation = []
-        for n, subject in enumerate(self.list()):
-            i = n*6
-            _order[i:i+6] = subject.id
-            _labels[i:i+6] = subject.label
-            rotation[i:i+6] = range(6)
-
-            charge = subject.scaled_charge
-            charges[i] = charge
-            for m in range(1, 6):
-                charges[i + m] = cr.rotate(charge, m)
-
-        out = [charges]
+    def _rotated_charge_array(self, order=True, labels=False,
+                              rotation=True):
+        out = [self._cached('x', rotation)]
         if order:
-            out = [_order] + out
+            out = [self._cached('ids', rotation)] + out
         if labels:
-            out += [_labels]
-        out += [rotation]
+            out += [self._cached('labels', rotation)]
+        out += [self._cached('rotation', rotation)]
         return tuple(out)
 
+    def canonical_charge(self, reflect=True):
+        """
+        Scaled charges with each subject mapped to its canonical
+        orientation, so subjects that differ only by a rotation or
+        reflection have identical rows
+        """
+        def build():
+            return CameraRotate().canonical(self.scaled_charge, reflect)[0]
+        return self._cache.get(('canonical', reflect), build)
+
+    @staticmethod
+    def symmetries(rotation):
+        """
+        Number of copies of each subject for a rotation option
+        """
+        return len(CameraRotate().group(rotation))
+
+    def _cached(self, kind, rotation):
+        """
+        Derived array of the given kind, built at most once until
+        labels change or it is evicted from the cache
+
+        kind: one of x, ids, labels or rotation
+        """
+        if self._arrays.version != self._cache_version:
+            self._cache.clear(lambda key: key[0] == 'labels')
+            self._cache_version = self._arrays.version
+
+        if kind == 'x' and not rotation and self._rows is None:
+            # The scaled charges are already stored, so return them
+            # read only instead of caching a second copy
+            x = self._arrays.scaled_charge.view()
+            x.flags.writeable = False
+            return x
+
+        def build():
+            n = self.symmetries(rotation)
+            if kind == 'x':
+                if rotation:
+                    return self._rotate_all(self.scaled_charge, rotation)
+                # Views select their rows into a new array already
+                return self.scaled_charge
+            elif kind == 'ids':
+                return np.repeat(self.ids, n)
+            elif kind == 'labels':
+                return np.repeat(self.labels, n)
+            elif kind == 'rotation':
+                return np.tile(np.arange(n), len(self))
+            raise KeyError(kind)
+
+        return self._cache.get((kind, rotation), build)
+
+    def fit_rings(self, **kwargs):
+        """
+        Fit a ring to each subject and store the radius, centre, fit
+        residual and ring completeness as features
+
+        kwargs: RingFit options
+        """
+        fit = RingFit(**kwargs)
+        columns = self._map_chunks(fit.fit, fit.chunk)
+        self.set_features(columns)
+        self._arrays.feature_options['ring'] = fit.options()
+        return columns
+
+    def hillas(self, cache=None, **kwargs):
+        """
+        Hillas parameters of each subject, stored as features
+
+        cache: npz file of previously computed parameters. Only subjects
+               missing from it are computed, and the file is updated.
+               A file computed with other options is replaced.
+        kwargs: Hillas options
+
+        Stored parameters computed with other options are recomputed
+        """
+        hillas = Hillas(**kwargs)
+        names = hillas.columns
+        options = hillas.options()
+
+        arrays = self._arrays
+        if arrays.feature_options.get('hillas') != options:
+            for name in names:
+                arrays.features.pop(name, None)
+
+        fresh = False
+        if cache is not None and os.path.isfile(cache):
+            stored = self.feature_file_options(cache).get('hillas')
+            fresh = stored == options
+            if fresh:
+                self.load_features(cache)
+            else:
+                os.remove(cache)
+        arrays.feature_options['hillas'] = options
+
+        # size is only nan for subjects that were never computed
+        missing = np.arange(len(self))
+        if names[0] in self._arrays.features:
+            size = self._select(self._arrays.features[names[0]])
+            missing = np.where(np.isnan(size))[0]
+
+        if len(missing) > 0:
+            subjects = self._take(missing)
+            subjects.set_features(
+                subjects._map_chunks(hillas.params, hillas.chunk))
+        if cache is not None and (len(missing) > 0 or not fresh):
+            self.save_features(cache, names)
+
+        return self.features(names)
+
+    def _map_chunks(self, func, chunk):
+        """
+        Apply func to the charges in chunks of rows, concatenating the
+        dicts of columns it returns, so memory mapped charges are read
+        one chunk at a time
+        """
+        out = OrderedDict()
+        for a in range(0, len(self), chunk):
+            rows = np.arange(a, min(len(self), a + chunk))
+            for name, column in func(self.charge_rows(rows)).items():
+                out.setdefault(name, []).append(column)
+        return OrderedDict((k, np.concatenate(v)) for k, v in out.items())
+
+    def keep_scaled_only(self, dtype='float32'):
+        """
+        Drop the raw charges and keep only the scaled charges as dtype,
+        roughly halving resident memory. Affects every view sharing
+        this container's storage.
+        """
+        self._arrays.keep_scaled_only(dtype)
+        self._cache.clear()
+
+    def cache_info(self):
+        """
+        Hit and miss counts and memory use of the derived array cache
+        """
+        return self._cache.info()
+
+    @staticmethod
+    def _rotate_all(charges, rotation=True):
+        """
+        Stack the rotations (and reflections, if rotation is 'reflect')
+        of each row, keeping each row's copies next to each other
+        """
+        cr = CameraRotate()
+        return cr.rotate_many(charges, range(len(cr.group(rotation))))
+
     ##########################################################################
     ###   Operator Overloading   #############################################
     ##########################################################################
 
     def __getitem__(self, subject):
-        return self.subjects[subject]
+        row = self._storage_row(self.index[subject])
+        return SubjectView(self._arrays, row)
+
+    def __contains__(self, subject):
+        return subject in self.index
 
     def __len__(self):
-        return len(self.subjects)
+        if self._rows is None:
+            return len(self._arrays)
+        return len(self._rows)
 
     def __str__(self):
-        return '%d subjects' % len(self.subjects)
+        return '%d subjects' % len(self)
 
     def __repr__(self):
         return str(self)
 
+    def __getstate__(self):
+        if self._rows is not None:
+            # Only pickle the rows of a view, not the shared storage
+            return self.materialize().__getstate__()
+        return {'_arrays': self._arrays}
+
+    def __setstate__(self, state):
+        if 'subjects' in state:
+            # Subjects pickled before the array layout kept an
+            # OrderedDict of Subject objects
+            self.__init__(list(state['subjects'].values()))
+        else:
+            self._init_arrays(state['_arrays'])
+
+    ##########################################################################
+    ###   Saving and Loading   ###############################################
+    ##########################################################################
+
+    @staticmethod
+    def load(fname):
+        """
+        Load subjects from a pickle file, or open a memory mapped
+        subject store if fname is a directory
+        """
+        if os.path.isdir(fname):
+            return MappedSubjects(fname)
+        with open(fname, 'rb') as file:
+            return pickle.load(file)
+
+    def save_mapped(self, path):
+        """
+        Save subjects as a memory mapped store that can be opened
+        with MappedSubjects
+        """
+        charge = MappedSubjects.create(
+            path, self.ids, self.events, self.labels, self.dimensions[1])
+        charge[:] = self.charge
+        charge.flush()
+
+
+class MappedSubjects(Subjects):
+    """
+    Subjects whose charges live in a read only memory mapped matrix.
+
+    Opening a store only reads the id, event and label columns, and
+    Subject objects are created when they are accessed. Processes
+    opening the same store share the charge pages through the OS
+    page cache.
+    """
+
+    files = {
+        'subject': 'subject.npy',
+        'event': 'event.npy',
+        'label': 'label.npy',
+        'charge': 'charge.npy',
+        'scaled': 'scaled.npy',
+    }
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+        def fname(key):
+            return os.path.join(self.path, self.files[key])
+
+        scaled = None
+        if os.path.isfile(fname('scaled')):
+            scaled = np.load(fname('scaled'), mmap_mode='r')
+
+        self._init_arrays(SubjectArrays(
+            np.load(fname('subject')),
+            np.load(fname('charge'), mmap_mode='r'),
+            np.load(fname('event')),
+            np.load(fname('label')),
+            scaled))
+
+    @classmethod
+    def create(cls, path, ids, events, labels, width):
+        """
+        Write the id, event and label columns of a new store and
+        return its writable (N x width) charge matrix
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        def fname(key):
+            return os.path.join(path, cls.files[key])
+
+        # Scaled charges saved for an earlier store in the same
+        # directory would be loaded in place of the new ones
+        if os.path.isfile(fname('scaled')):
+            os.remove(fname('scaled'))
+
+        np.save(fname('subject'), np.array(ids, dtype='int64'))
+        np.save(fname('event'), np.array(events, dtype='int64'))
+        np.save(fname('label'), np.array(labels, dtype='int64'))
+
+        return np.lib.format.open_memmap(
+            fname('charge'), mode='w+', dtype='float32',
+            shape=(len(ids), width))
+
+    def save_scaled(self, dtype='float32'):
+        """
+        Write the scaled charges to the store, so they are memory
+        mapped too instead of computed in every process
+        """
+        fname = os.path.join(self.path, self.files['scaled'])
+        scaled = np.lib.format.open_memmap(
+            fname, mode='w+', dtype=dtype, shape=self.dimensions)
+        SubjectArrays.scale(self._arrays.charge, dtype, out=scaled)
+        scaled.flush()
+        del scaled
+
+        self._arrays._scaled_charge = np.load(fname, mmap_mode='r')
+        self._cache.clear()
+
+    def save_labels(self):
+        fname = os.path.join(self.path, self.files['label'])
+        np.save(fname, self._arrays.labels)
+
+    _view_class = Subjects
+
+    def __getstate__(self):
+        return {'path': self.path, 'labels': self._arrays.labels}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+        self._arrays.labels = state['labels']
+
+
+
+class ArrayCache:
+    """
+    Least recently used cache of read only numpy arrays, evicting
+    entries once their total size exceeds a memory budget in bytes
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        value = build()
+        value.flags.writeable = False
+
+        if value.nbytes <= self.budget:
+            self.entries[key] = value
+            self.size += value.nbytes
+            while self.size > self.budget:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old.nbytes
+        return value
+
+    def clear(self, match=None):
+        """
+        Remove every entry, or only the entries whose key matches
+        """
+        for key in list(self.entries):
+            if match is None or match(key):
+                self.size -= self.entries.pop(key).nbytes
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'size': self.size,
+            'budget': self.budget,
+        }
+
 
 class Subject_Data:
 
@@ -465,8 +1197,11 @@ class Subject_Data:
 
         return (run, event, tel)
 
-    @classmethod
-    def raw_files(cls, args):
+    @staticmethod
+    def raw_paths(args):
+        """
+        Sorted list of raw .hdf5 files in the given files and directories
+        """
         print('loading files from %s' % str(args))
         paths = []
         for path in args:
@@ -475,13 +1210,19 @@ class Subject_Data:
                 for fname in os.listdir(path):
                     print(fname)
                     if os.path.splitext(fname)[1] == '.hdf5':
-                        if path not in paths:
-                            paths.append(os.path.join(path, fname))
+                        fname = os.path.join(path, fname)
+                        if fname not in paths:
+                            paths.append(fname)
 
             elif os.path.splitext(path)[1] == '.hdf5':
                 if path not in paths:
                     paths.append(path)
 
+        return sorted(paths)
+
+    @classmethod
+    def raw_files(cls, args):
+        paths = cls.raw_paths(args)
         print('loading paths %s' % paths)
         bar = progressbar.ProgressBar()
         for fname in bar(paths):
@@ -490,9 +1231,15 @@ class Subject_Data:
                 yield item
 
     @staticmethod
-    def raw_file(fname):
-        print('Loading subjects from %s' % fname)
-        bar = progressbar.ProgressBar()
+    def raw_file(fname, verbose=True):
+        """
+        verbose: report the file and draw a progress bar over its
+                 events, off when decoding in worker processes
+        """
+        bar = iter
+        if verbose:
+            print('Loading subjects from %s' % fname)
+            bar = progressbar.ProgressBar()
         with h5py.File(fname) as file:
             for run in file:
                 for event in bar(file[run]):
@@ -506,3 +1253,392 @@ class Subject_Data:
                         raise
                     yield(run, event, charge)
 
+
+
+class Columnar_Data:
+    """
+    Subject data stored as parallel columns in a single hdf5 file.
+
+    Instead of a group per run and event, every event is a row in one
+    chunked (N x width) charge dataset, with the subject id and
+    (run, evt, tel) of each row in aligned one dimensional datasets.
+
+    Rows are committed in batches. The stats group records how many rows
+    are committed and a manifest records which raw files have been fully
+    ingested, so an interrupted ingest is rolled back to its last batch
+    and a rerun only decodes new or modified raw files.
+    """
+
+    columns = ['subject', 'run', 'evt', 'tel']
+    width = 500
+    chunk = 1024
+    batch = 4096
+    # Raw files decoded ahead of the writer, per worker
+    window = 2
+
+    def __init__(self, data_file):
+        self.num = 0
+        self.output = data_file
+
+        self._file = None
+        self._keys = None
+        self._buffer = []
+        self._buffered = 0
+        self._manifest = None
+        self._pending = []
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = self.load()
+        return self._file
+
+    @classmethod
+    def is_columnar(cls, data_file):
+        if not os.path.isfile(data_file):
+            return False
+        with h5py.File(data_file, 'r') as file:
+            return 'charge' in file and \
+                isinstance(file['charge'], h5py.Dataset)
+
+    def load(self):
+        if os.path.isfile(self.output):
+            file = h5py.File(self.output, 'r+')
+            if 'charge' not in file:
+                raise IOError('%s is not a columnar data file' % self.output)
+            self.num = int(file['stats'].attrs['num'])
+            self._rollback(file)
+        else:
+            file = h5py.File(self.output, 'w')
+            stats = file.create_group('stats')
+            stats.attrs['num'] = self.num
+            stats.attrs['rows'] = 0
+            stats.attrs['layout'] = 'columnar'
+
+            for column in self.columns:
+                file.create_dataset(
+                    column, (0,), dtype='int64', maxshape=(None,),
+                    chunks=(self.chunk,))
+            file.create_dataset(
+                'charge', (0, self.width), dtype='float32',
+                maxshape=(None, self.width), chunks=(self.chunk, self.width),
+                compression='gzip')
+
+        return file
+
+    def _rollback(self, file):
+        """
+        Drop rows written after the last committed batch
+        """
+        rows = file['stats'].attrs.get('rows', file['subject'].shape[0])
+        for column in self.columns:
+            if file[column].shape[0] != rows:
+                file[column].resize((rows,))
+        if file['charge'].shape[0] != rows:
+            print('Rolling back %s to %d committed rows' %
+                  (self.output, rows))
+            file['charge'].resize((rows, self.width))
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return self.file['subject'].shape[0]
+
+    @property
+    def keys(self):
+        """
+        Set of (run, evt, tel) already stored in the file
+        """
+        if self._keys is None:
+            file = self.file
+            run, evt, tel = [file[c][:] for c in ['run', 'evt', 'tel']]
+            self._keys = set(zip(run.tolist(), evt.tolist(), tel.tolist()))
+        return self._keys
+
+    ##########################################################################
+    ###   Ingest Manifest   ##################################################
+    ##########################################################################
+
+    @property
+    def manifest(self):
+        """
+        Raw files already ingested, mapped to their size and mtime
+        """
+        if self._manifest is None:
+            manifest = {}
+            if 'manifest' in self.file:
+                data = self.file['manifest'][()]
+                if isinstance(data, bytes):
+                    data = data.decode('utf-8')
+                manifest = json.loads(data)
+            self._manifest = manifest
+        return self._manifest
+
+    @staticmethod
+    def file_stat(fname):
+        stat = os.stat(fname)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def ingested(self, fname):
+        """
+        Check if a raw file was fully ingested and is unchanged since
+        """
+        entry = self.manifest.get(os.path.abspath(fname))
+        return entry == self.file_stat(fname)
+
+    def _save_manifest(self):
+        file = self.file
+        if 'manifest' in file:
+            del file['manifest']
+        file['manifest'] = json.dumps(self.manifest)
+
+    ##########################################################################
+    ###   Reading   ##########################################################
+    ##########################################################################
+
+    def read(self, start=0, stop=None):
+        """
+        Bulk read of every column between rows start and stop
+        """
+        file = self.file
+        if stop is None:
+            stop = len(self)
+        data = {c: file[c][start:stop] for c in self.columns}
+        data['charge'] = file['charge'][start:stop]
+        return data
+
+    def __iter__(self):
+        length = len(self)
+        for a in range(0, length, self.chunk):
+            data = self.read(a, min(length, a + self.chunk))
+            for i, subject in enumerate(data['subject']):
+                _event = (data['run'][i], data['evt'][i], data['tel'][i])
+                yield (subject, _event, data['charge'][i])
+
+    ##########################################################################
+    ###   Writing   ##########################################################
+    ##########################################################################
+
+    def load_raw(self, args, workers=1):
+        """
+        Ingest raw files, decoding them in a pool of worker processes.
+
+        Files are decoded in sorted path order and written by this
+        process alone, so subject ids do not depend on the number
+        of workers. At most window files per worker are in flight, so
+        decoded files do not pile up in memory when writing is slower
+        than decoding.
+        """
+        paths = Subject_Data.raw_paths(args)
+        new = [p for p in paths if not self.ingested(p)]
+        print('skipping %d ingested files' % (len(paths) - len(new)))
+        paths = new
+        print('loading paths %s' % paths)
+
+        bar = progressbar.ProgressBar(max_value=len(paths))
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                pending = []
+                done = 0
+                for n, fname in enumerate(paths):
+                    result = pool.apply_async(self.decode_file, (fname,))
+                    pending.append((fname, result))
+
+                    # Write the oldest file once the window is full, or
+                    # drain the window after the last file
+                    while pending and (len(pending) >= self.window * workers
+                                       or n == len(paths) - 1):
+                        fname, result = pending.pop(0)
+                        self.extend(result.get(), fname)
+                        done += 1
+                        bar.update(done)
+            bar.finish()
+        else:
+            for fname in bar(paths):
+                self.extend(self.decode_file(fname), fname)
+
+        self.close()
+
+    @classmethod
+    def decode_file(cls, fname):
+        """
+        Read and validate every event in a raw file
+
+        Returns a dict of run, evt, tel and charge arrays
+        """
+        rows = []
+        skipped = 0
+        for run, event, charge in Subject_Data.raw_file(fname, False):
+            charge = charge[:]
+            if charge.shape != (cls.width,) or \
+                    not np.isfinite(charge).all():
+                skipped += 1
+                continue
+            rows.append((*Subject_Data.parse_event(run, event), charge))
+
+        if skipped:
+            print('Skipped %d malformed events in %s' % (skipped, fname))
+
+        if not rows:
+            return None
+
+        run, evt, tel, charge = zip(*rows)
+        return {
+            'run': np.array(run, dtype='int64'),
+            'evt': np.array(evt, dtype='int64'),
+            'tel': np.array(tel, dtype='int64'),
+            'charge': np.stack(charge).astype('float32'),
+        }
+
+    def add(self, run, event, charge):
+        """
+        Queue a raw event to be written with the next batch
+        """
+        run, evt, tel = Subject_Data.parse_event(run, event)
+        self.extend({
+            'run': np.array([run]),
+            'evt': np.array([evt]),
+            'tel': np.array([tel]),
+            'charge': np.asarray(charge)[np.newaxis],
+        })
+
+    def extend(self, data, fname=None):
+        """
+        Queue a batch of decoded events, assigning subject ids to
+        events not already in the file
+
+        fname: raw file the events were decoded from. It is marked as
+               ingested in the manifest when the batch is committed.
+        """
+        if fname is not None:
+            self._pending.append(fname)
+        if data is None:
+            return
+
+        keep = []
+        keys = zip(data['run'].tolist(), data['evt'].tolist(),
+                   data['tel'].tolist())
+        for i, key in enumerate(keys):
+            if key not in self.keys:
+                self.keys.add(key)
+                keep.append(i)
+
+        if not keep:
+            return
+
+        data = {k: v[keep] for k, v in data.items()}
+        data['subject'] = np.arange(self.num, self.num + len(keep))
+        self.num += len(keep)
+
+        self._buffer.append(data)
+        self._buffered += len(keep)
+        if self._buffered >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit buffered events and mark their raw files as ingested
+        """
+        if self._buffer:
+            data = {k: np.concatenate([b[k] for b in self._buffer])
+                    for k in self._buffer[0]}
+            self.append(data)
+            self._buffer = []
+            self._buffered = 0
+
+        if self._pending:
+            for fname in self._pending:
+                path = os.path.abspath(fname)
+                self.manifest[path] = self.file_stat(fname)
+            self._pending = []
+            self._save_manifest()
+            self.file.flush()
+
+    def append(self, data):
+        """
+        Append a batch of rows to every column
+
+        data: dict of column name to array, including charge
+        """
+        file = self.file
+        length = len(data['subject'])
+        a = len(self)
+        b = a + length
+
+        for column in self.columns:
+            file[column].resize((b,))
+            file[column][a:b] = data[column]
+        file['charge'].resize((b, self.width))
+        file['charge'][a:b] = data['charge']
+
+        num = max(self.num, int(np.max(data['subject'])) + 1)
+        self.num = num
+        file['stats'].attrs['num'] = num
+        file['stats'].attrs['rows'] = b
+
+    def export(self, path):
+        """
+        Write a memory mapped subject store, dropping the last
+        charge column like Subjects.from_data
+        """
+        file = self.file
+        ids = file['subject'][:]
+        events = np.stack([file[c][:] for c in ['run', 'evt', 'tel']], 1)
+        labels = np.full(len(ids), -1)
+
+        charge = MappedSubjects.create(
+            path, ids, events, labels, self.width - 1)
+        for a in range(0, len(ids), self.chunk * 16):
+            b = min(len(ids), a + self.chunk * 16)
+            charge[a:b] = file['charge'][a:b, :-1]
+        charge.flush()
+
+    @classmethod
+    def convert(cls, source, output, overwrite=False):
+        """
+        Convert a Subject_Data file with one group per event to
+        the columnar layout, keeping the same subject ids
+
+        overwrite: replace an existing output file. Rows are appended
+                   with their source ids, bypassing the (run, evt, tel)
+                   check of extend, so the output must start empty.
+        """
+        if os.path.isfile(output):
+            if not overwrite:
+                raise Exception('Refusing to convert into existing file '
+                                '%s' % output)
+            os.remove(output)
+
+        subject_data = Subject_Data(source)
+        columnar = cls(output)
+
+        def batch(rows):
+            subject, events, charge = zip(*rows)
+            run, evt, tel = zip(*events)
+            columnar.append({
+                'subject': np.array(subject),
+                'run': np.array(run),
+                'evt': np.array(evt),
+                'tel': np.array(tel),
+                'charge': np.stack(charge),
+            })
+
+        rows = []
+        for subject, event, charge in subject_data:
+            rows.append((subject, event, charge[:]))
+            if len(rows) >= cls.batch:
+                batch(rows)
+                rows = []
+        if rows:
+            batch(rows)
+
+        columnar.num = max(columnar.num, subject_data.num)
+        columnar.file['stats'].attrs['num'] = columnar.num
+
+        subject_data.close()
+        columnar.close()
+        return columnar